@@ -1,8 +1,11 @@
 """Curriculum Learning Sampler"""
 import logging
+import torch
+import numpy as np
 from tqdm import trange
-from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data import RandomSampler
 from torch import sqrt
+from common.data import build_data_loader
 
 
 ###########################
@@ -14,33 +17,29 @@ class BucketCurriculum(object):
     2. Split data to buckets accord. to difficulty. Each bucket as one 'curriculum'.
     3. Yield one curriculum after the other.
     """
-    def __init__(self, dataset, scoring_fn):
+    def __init__(self, dataset, scorer, **kwargs):
         """
-        dataset (FewShotWozDataset): Dataset that returns self.intents and self.utterances
-        scoring_fn (Callable):
-            input: intents(Str), utterance(Str)
-            output: scores (Float/Int) that measure how hard the example is
+        dataset (TokenizedDataset): Dataset to be split into curricula
+        scorer (Str): name of a difficulty scorer in DIFFICULTY_SCORERS
+        kwargs: passed to the scorer
         """
         self.dataset = dataset
-        self.intents = dataset.intents
-        self.utterances = dataset.utterances
-        self.difficulty = [scoring_fn(i, u) for i, u in zip(self.intents, self.utterances)]
+        self.difficulty = score_difficulty(scorer, dataset, **kwargs)
 
         # sort by difficulty score
-        sort_by_diff = sorted(zip(self.intents, self.utterances, self.difficulty), key=lambda pair: pair[2])
-        self.intents, self.utterances, self.difficulty = zip(*sort_by_diff)
+        self.sorted_indices = np.argsort(self.difficulty, kind='stable')
 
-    def get_curriculum(self, num_bucket, batch_size, name, collate_fn):
+    def get_curriculum(self, num_bucket, batch_size, name, collate_fn, bucket_batching=False, max_tokens=0):
         """
         num_bucket (Int): number of buckets / curriculum to split the dataset into
         batch_size (Int): train batch_size for each bucket
         name (Str): [one_pass, baby_step]
+        bucket_batching (Bool): batch examples of similar token lengths together
+        max_tokens (Int): if > 0, token budget (src + tgt) per batch
         Yield:
-             same dataset class as inputted to the constructor function
+             (DataLoader over the bucket's indices of the dataset, number of instances in the bucket)
         """
-        dataset_class = self.dataset.__class__
         dataset_len = len(self.dataset)
-        dataset_separator = self.dataset.separator
 
         bucket_size = dataset_len // num_bucket
         tot_num_bucket = num_bucket + 1 if dataset_len % num_bucket > 0 else num_bucket  # the last incomplete bucket
@@ -59,71 +58,212 @@ class BucketCurriculum(object):
                 start, end = 0, min(b * bucket_size + bucket_size, dataset_len)
             else:
                 raise ValueError("Invalid BucketCurriculum name. Must be in [one_pass, baby_step].")
-            curriculum_dataset = dataset_class(self.intents[start: end], self.utterances[start: end], dataset_separator)
-            curriculum_dataloader = DataLoader(curriculum_dataset, batch_size=batch_size,
-                                               sampler=RandomSampler(curriculum_dataset),
-                                               collate_fn=collate_fn, drop_last=False)
-            yield curriculum_dataloader, len(curriculum_dataset)
+            curriculum_indices = self.sorted_indices[start: end]
+            curriculum_dataloader = build_data_loader(self.dataset, batch_size, RandomSampler, collate_fn,
+                                                      bucket_batching, max_tokens, curriculum_indices)
+            yield curriculum_dataloader, len(curriculum_indices)
 
 
 ########################
 #  Dynamic Curriculum  #
 ########################
 class DynamicCurriculum(object):
-    def __init__(self, dataset):
+    def __init__(self, dataset, c0):
         """
-        dataset (AbstractDataset): Dataset that returns self.intents and self.utterances
-        scoring_fn (Callable):
-            input: intents(Str), utterance(Str)
-            output: scores (Float/Int) that measure how hard the example is
+        dataset (TokenizedDataset): Dataset to be sorted by the per-sample difficulties of each phase
+        c0 (float): initial model competence
+        self.competences (List[float]): c_s, the initial competence then the competence of each phase
+        self.difficulties (np.ndarray[N,]): sample difficulties of the current phase
         """
-        self.intents = dataset.intents
-        self.utterances = dataset.utterances
-        self.dataset_class = type(dataset)
+        self.dataset = dataset
         self.data_len = len(dataset)
+        self.competences = [c0]
+        self.difficulties = np.empty(self.data_len)
+
+    def state_dict(self):
+        return {"competences": [float(c) for c in self.competences],
+                "difficulties": torch.from_numpy(self.difficulties.copy())}
+
+    def load_state_dict(self, state):
+        """ in place: callers may hold references to competences and difficulties """
+        self.competences[:] = state["competences"]
+        np.copyto(self.difficulties, state["difficulties"].numpy())
 
     def sort_by_diff(self, difficulties):
-        sort_by_diff = sorted(zip(self.intents, self.utterances, difficulties), key=lambda pair: pair[2])
-        sorted_intents, sorted_utterances, sorted_difficulty = zip(*sort_by_diff)
-        return sorted_intents, sorted_utterances, sorted_difficulty
+        """ return: example indices sorted from the easiest to the hardest """
+        return np.argsort(difficulties, kind='stable')
 
-    def get_curriculum(self, difficulties, competence, batch_size, collate_fn):
+    def get_curriculum(self, difficulties, competence, batch_size, collate_fn, bucket_batching=False, max_tokens=0):
         """
         batch_size (Int): train batch_size for each bucket
         competence (float): Range = (0,1]. The model competence, i.e. the percentage of dataset that can be used.
+        bucket_batching (Bool): batch examples of similar token lengths together
+        max_tokens (Int): if > 0, token budget (src + tgt) per batch
         """
-        sorted_intents, sorted_utterances, sorted_difficulty = self.sort_by_diff(difficulties)
+        sorted_indices = self.sort_by_diff(difficulties)
         n_example = int(self.data_len * competence)
 
-        curriculum_dataset = self.dataset_class(sorted_intents[: n_example], sorted_utterances[: n_example])
-        dataloader = DataLoader(curriculum_dataset, batch_size=batch_size, sampler=RandomSampler(curriculum_dataset),
-                                collate_fn=collate_fn, drop_last=False)
+        dataloader = build_data_loader(self.dataset, batch_size, RandomSampler, collate_fn, bucket_batching,
+                                       max_tokens, sorted_indices[: n_example])
         return dataloader
 
 
-# given intent and utterance str, measure the difficulty of the sample
-def length_score_fn(intent, utterance):
-    return len(intent.split()) + len(utterance.split())
+class SampleLossTracker(object):
+    """
+    Latest training loss of each sample, recorded from the training batches. Kept on device, so no host sync.
+    Used by DCL to get sample difficulties without a full loss pass over the training set every phase.
+    The losses are masked to each sample's own target tokens, so they do not depend on the other samples of the batch.
+    They are not exactly comparable with those of a refresh pass (evaluate_data_set): a recorded loss is taken in
+    train mode (with dropout) and before that step's update. Use --dcl_full_loss_pass for eval-mode losses only.
+    self.losses (torch.Tensor[N,]): latest loss of each sample. nan if never seen.
+    self.updated (torch.BoolTensor[N,]): whether the sample was seen since the last start_phase().
+    """
+    def __init__(self, num_samples, device):
+        self.losses = torch.full((num_samples,), float('nan'), device=device)
+        self.updated = torch.zeros(num_samples, dtype=torch.bool, device=device)
+
+    def update(self, example_ids, losses):
+        example_ids = torch.as_tensor(example_ids, device=self.losses.device)
+        self.losses[example_ids] = torch.as_tensor(losses, dtype=self.losses.dtype, device=self.losses.device)
+        self.updated[example_ids] = True
+
+    def start_phase(self):
+        self.updated.zero_()
+
+    def stale_indices(self):
+        """ samples whose loss was not recorded since the last start_phase() """
+        return torch.nonzero(~self.updated, as_tuple=True)[0].cpu().numpy()
+
+    def snapshot(self):
+        return self.losses.cpu().numpy().copy()
 
+    def state_dict(self):
+        return {"losses": self.losses.cpu(), "updated": self.updated.cpu()}
 
-def intent_slot_score_fn(intent, utterance):
-    def count_intent_slot(intent):
-        import re
-        intent_sep = '|'
-        slot_sep = ';'
-        # pattern = re.compile(r'\((.*?)\)')
+    def load_state_dict(self, state):
+        self.losses.copy_(state["losses"])
+        self.updated.copy_(state["updated"])
 
-        intents = intent.split(intent_sep)
-        num_intents, num_slots = len(intents), 0
 
-        for i in intents:
-            slot_vals = i.split(slot_sep)
-            num_slots += len(slot_vals)
+class PhaseLossBuffer(object):
+    """
+    Ring buffer of the per-sample losses of the last `window + 1` DCL phases, preallocated as one
+    (window + 1, N) matrix. Optionally a memory-mapped .npy file when N is too large for RAM.
+    """
+    def __init__(self, num_samples, window, mmap_path=None, dtype=np.float64):
+        shape = (window + 1, num_samples)
+        if mmap_path:
+            self.rows = np.lib.format.open_memmap(mmap_path, mode='w+', dtype=dtype, shape=shape)
+        else:
+            self.rows = np.empty(shape, dtype=dtype)
+        self.capacity = window + 1
+        self.num_rows = 0
+        self.head = 0  # row to write next
 
-        return num_intents, num_slots
+    def append(self, losses):
+        """ overwrite the oldest row once the buffer is full """
+        self.rows[self.head] = losses
+        self.head = (self.head + 1) % self.capacity
+        self.num_rows = min(self.num_rows + 1, self.capacity)
 
-    num_intents, num_slots = count_intent_slot(intent)
-    return num_intents * 100 + num_slots  # TODO: this is evil. Assume num_slot_per_intent < 100
+    def newest(self):
+        return self.rows[(self.head - 1) % self.capacity]
+
+    def oldest(self):
+        return self.rows[(self.head - self.num_rows) % self.capacity]
+
+    def difficulties(self, out):
+        """
+        Computed into `out` (np.ndarray[N,]):
+            fewer than window + 1 phases recorded: the newest losses.
+            otherwise: relative loss change from the oldest to the newest phase, (newest - oldest) / oldest.
+        """
+        if self.num_rows < self.capacity:
+            np.copyto(out, self.newest())
+        else:
+            np.subtract(self.newest(), self.oldest(), out=out)
+            np.divide(out, self.oldest(), out=out)
+        return out
+
+    def state_dict(self):
+        return {"rows": torch.from_numpy(np.array(self.rows)), "num_rows": self.num_rows, "head": self.head}
+
+    def load_state_dict(self, state):
+        self.rows[:] = state["rows"].numpy()
+        self.num_rows, self.head = state["num_rows"], state["head"]
+
+
+###########################
+#   Difficulty Scorers    #
+###########################
+# scorer(dataset (TokenizedDataset), **kwargs) -> np.ndarray[n,] of difficulties, higher is harder.
+# Scorers work on whole arrays of the dataset, never per example.
+DIFFICULTY_SCORERS = {}
+INTENT_SEP = '|'
+SLOT_SEP = ';'
+
+
+def register_scorer(name):
+    def register(scorer):
+        DIFFICULTY_SCORERS[name] = scorer
+        return scorer
+    return register
+
+
+def score_difficulty(name, dataset, **kwargs):
+    if name not in DIFFICULTY_SCORERS:
+        raise ValueError(f"Invalid difficulty scorer {name}. Must be in {list(DIFFICULTY_SCORERS)}.")
+    return np.asarray(DIFFICULTY_SCORERS[name](dataset, **kwargs))
+
+
+@register_scorer("length")
+def length_scores(dataset):
+    """ number of intent + utterance tokens """
+    return dataset.intent_ids.lengths() + dataset.utter_ids.lengths()
+
+
+@register_scorer("intent_count")
+def intent_count_scores(dataset):
+    return dataset.intents.count(INTENT_SEP) + 1
+
+
+@register_scorer("slot_count")
+def slot_count_scores(dataset):
+    """ number of slot-value pairs, counting an intent without slots as one """
+    return intent_count_scores(dataset) + dataset.intents.count(SLOT_SEP)
+
+
+@register_scorer("intent_slot")
+def intent_slot_scores(dataset):
+    """ sort by number of intents, then by number of slots """
+    return intent_count_scores(dataset) * 100 + slot_count_scores(dataset)  # Assume num_slot_per_intent < 100
+
+
+@register_scorer("rarity")
+def rarity_scores(dataset):
+    """ mean negative log unigram probability of the intent + utterance tokens, counted over the dataset """
+    token_ids = (dataset.intent_ids, dataset.utter_ids)
+    vocab_size = max(int(ids.values.max()) + 1 for ids in token_ids)
+    counts = sum(np.bincount(ids.values, minlength=vocab_size) for ids in token_ids)
+    neg_log_prob = np.log(counts.sum()) - np.log(np.maximum(counts, 1))
+    total = sum(ids.row_sums(neg_log_prob[ids.values]) for ids in token_ids)
+    return total / np.maximum(length_scores(dataset), 1)
+
+
+# model-based: baseline_metrics ({metric: np.ndarray}) are the per-sample metrics of a trained baseline model
+@register_scorer("baseline_loss")
+def baseline_loss_scores(dataset, baseline_metrics):
+    return baseline_metrics["loss"]
+
+
+@register_scorer("baseline_bleu")
+def baseline_bleu_scores(dataset, baseline_metrics):
+    return -baseline_metrics["bleu"]
+
+
+@register_scorer("baseline_accu")
+def baseline_accu_scores(dataset, baseline_metrics):
+    return -baseline_metrics["accu"]
 
 
 ###########################
@@ -165,19 +305,25 @@ class SplRegularizer(object):
     def update_hyper(self):
         self.lam *= 1.3
 
+    def state_dict(self):
+        return {"lam": self.lam}
+
+    def load_state_dict(self, state):
+        self.lam = state["lam"]
+
 
 ###########################
 #   Main
 if __name__ == "__main__":
     from transformers import T5Tokenizer
-    from common.data import FewShotWozDataset
+    from common.data import FewShotWozDataset, TokenizedDataset
 
     train_file = "../data/restaurant/new.txt"
-    cache_path = "../data_cached/restaurant/new.bin"
 
     t5_tokenizer = T5Tokenizer.from_pretrained('t5-small')
-    dataset = FewShotWozDataset.from_txt_file(train_file, cache_path, '&', )
-    curriculum = BucketCurriculum(dataset, length_score_fn)
+    raw_dataset = FewShotWozDataset.from_txt_file(train_file, '&', )
+    dataset = TokenizedDataset.from_dataset(raw_dataset, t5_tokenizer, max_intent_len=40, max_utter_len=60)
+    curriculum = BucketCurriculum(dataset, "length")
 
     for bucket in curriculum.get_curriculum(num_bucket=4, name="one_pass"):
         pass
@@ -1,9 +1,14 @@
 import os
+import json
+import uuid
 import torch
-import pickle
+import glob
+import shutil
+import hashlib
 import logging
+import numpy as np
 
-from torch.utils.data import Dataset, DataLoader, SequentialSampler, RandomSampler
+from torch.utils.data import Dataset, DataLoader, Sampler, SequentialSampler, RandomSampler, SubsetRandomSampler
 from functools import partial
 
 
@@ -12,30 +17,15 @@ class AbstractDataset(Dataset):
     self.intents (List[str]): Dialogue Act string (the part before '&').
     self.utterances (List[str]): Natural language utterances string (the part after '&').
     """
-    def __init__(self, intents=[], utterances=[], separator=""):
+    def __init__(self, intents=None, utterances=None, separator=""):
         self.separator = separator
-        self.intents = intents
-        self.utterances = utterances
+        self.intents = [] if intents is None else intents
+        self.utterances = [] if utterances is None else utterances
 
     @staticmethod
-    def from_bin_file(path):
-        """ load from cached .bin"""
-        with open(path, 'rb') as handle:
-            abstract_dataset = pickle.load(handle)
-        return abstract_dataset
-
-    @staticmethod
-    def from_txt_file(input_path, cache_path, **kwargs):
+    def from_txt_file(input_path, **kwargs):
         raise NotImplementedError("This method needs to be implemented.")
 
-    @staticmethod
-    def cache_file(dataset, input_path, cache_dir):
-        os.makedirs(cache_dir, exist_ok=True)
-        filename = os.path.splitext(os.path.basename(input_path))[0]
-        cache_path = os.path.join(cache_dir, filename + ".bin")
-        with open(cache_path, 'wb') as handle:
-            pickle.dump(dataset, handle)
-
     def __len__(self):
         return len(self.intents)
 
@@ -46,7 +36,7 @@ class AbstractDataset(Dataset):
 class FewShotWozDataset(AbstractDataset):
     """ FewShotWoz Dataset """
     @staticmethod
-    def from_txt_file(input_path, cache_dir, separator='&', **kwargs):
+    def from_txt_file(input_path, separator='&', **kwargs):
         new_dataset = FewShotWozDataset()
         new_dataset.separator = separator
 
@@ -57,16 +47,13 @@ class FewShotWozDataset(AbstractDataset):
                 utter_str = str_split[1]
                 new_dataset.intents.append(code_str)
                 new_dataset.utterances.append(utter_str)
-
-        # cache
-        FewShotWozDataset.cache_file(new_dataset, input_path, cache_dir)
         return new_dataset
 
 
 class MultiwozSgdDataset(AbstractDataset):
     """ Multiwoz or SGD dataset """
     @staticmethod
-    def from_txt_file(input_path, cache_dir, **kwargs):
+    def from_txt_file(input_path, **kwargs):
         new_dataset = MultiwozSgdDataset()
 
         # process src file
@@ -78,12 +65,139 @@ class MultiwozSgdDataset(AbstractDataset):
         with open(kwargs['tgt_file'], encoding="utf-8") as f:
             for line in f:
                 new_dataset.utterances.append(line.lower())
-
-        # cache
-        MultiwozSgdDataset.cache_file(new_dataset, input_path, cache_dir)
         return new_dataset
 
 
+###########################
+#   Tokenized Dataset     #
+###########################
+class FlatArray(object):
+    """ Variable-length rows stored as one flat array plus an offsets index.
+    Row i is values[offsets[i]: offsets[i+1]].
+    """
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @staticmethod
+    def from_rows(rows, dtype):
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(row) for row in rows])
+        values = np.fromiter((v for row in rows for v in row), dtype=dtype, count=offsets[-1])
+        return FlatArray(values, offsets)
+
+    @classmethod
+    def load(cls, path_prefix, mmap_mode='r'):
+        values = np.load(f"{path_prefix}.values.npy", mmap_mode=mmap_mode)
+        offsets = np.load(f"{path_prefix}.offsets.npy", mmap_mode=mmap_mode)
+        return cls(values, offsets)
+
+    def save(self, path_prefix):
+        np.save(f"{path_prefix}.values.npy", self.values)
+        np.save(f"{path_prefix}.offsets.npy", self.offsets)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def row_sums(self, x):
+        """ x (np.ndarray): one number per value. return: sum of x over each row """
+        cumsum = np.zeros(len(x) + 1, dtype=np.result_type(x, np.int64))
+        np.cumsum(x, out=cumsum[1:])
+        return cumsum[self.offsets[1:]] - cumsum[self.offsets[:-1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.values[self.offsets[idx]: self.offsets[idx+1]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class TextArray(FlatArray):
+    """ Strings stored as flat utf-8 bytes. Decoded on access. """
+    @staticmethod
+    def from_strings(strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        flat = FlatArray.from_rows(encoded, np.uint8)
+        return TextArray(flat.values, flat.offsets)
+
+    def count(self, char):
+        """ number of occurrences of an ascii char in each string """
+        return self.row_sums(self.values == ord(char))
+
+    def __getitem__(self, idx):
+        return bytes(super().__getitem__(idx)).decode('utf-8')
+
+
+class TokenizedDataset(Dataset):
+    """
+    Pre-tokenized dataset, memory-mapped from the cache dir. Collate only pads.
+    self.intent_ids, self.utter_ids (FlatArray): int32 token ids, truncated to max_intent_len / max_utter_len.
+    self.intents, self.utterances (TextArray): the raw strings, for curriculum scoring and metrics.
+    Subsets (e.g. curricula) are index arrays passed to the samplers, not new datasets.
+    self.cache_key (Str): name of the cache dir it was loaded from, which hashes its source data and preprocessing.
+    """
+    FIELDS = ["intent_ids", "utter_ids", "intents", "utterances"]
+
+    def __init__(self, intent_ids, utter_ids, intents, utterances, separator="", cache_key=None):
+        self.separator = separator
+        self.cache_key = cache_key
+        self.intent_ids = intent_ids
+        self.utter_ids = utter_ids
+        self.intents = intents
+        self.utterances = utterances
+
+    @staticmethod
+    def from_dataset(dataset, tokenizer, max_intent_len, max_utter_len):
+        """ tokenize an AbstractDataset once """
+        intent_ids = tokenizer(list(dataset.intents), truncation=True, max_length=max_intent_len)['input_ids']
+        utter_ids = tokenizer(list(dataset.utterances), truncation=True, max_length=max_utter_len)['input_ids']
+        return TokenizedDataset(FlatArray.from_rows(intent_ids, np.int32), FlatArray.from_rows(utter_ids, np.int32),
+                                TextArray.from_strings(dataset.intents), TextArray.from_strings(dataset.utterances),
+                                dataset.separator)
+
+    @staticmethod
+    def from_cache(cache_path):
+        with open(os.path.join(cache_path, "meta.json"), 'r') as f:
+            meta = json.load(f)
+        intent_ids = FlatArray.load(os.path.join(cache_path, "intent_ids"))
+        utter_ids = FlatArray.load(os.path.join(cache_path, "utter_ids"))
+        intents = TextArray.load(os.path.join(cache_path, "intents"))
+        utterances = TextArray.load(os.path.join(cache_path, "utterances"))
+        return TokenizedDataset(intent_ids, utter_ids, intents, utterances, meta["separator"],
+                                os.path.basename(os.path.normpath(cache_path)))
+
+    def cache(self, cache_path, meta, overwrite=False):
+        """
+        Write to a tmp dir of this process first, then rename it to cache_path, so that an interrupted run never
+        leaves a partial cache behind and concurrent runs (e.g. the cells of run_grid.py) can build the same cache.
+        If another run renamed its cache first, that one is kept, unless overwrite (then this one replaces it).
+        """
+        tmp_path = f"{cache_path}.tmp.{uuid.uuid4().hex}"
+        os.makedirs(tmp_path)
+        for field in self.FIELDS:
+            getattr(self, field).save(os.path.join(tmp_path, field))
+        with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+            json.dump(dict(meta, separator=self.separator, num_examples=len(self)), f, indent=2)
+        if overwrite:
+            shutil.rmtree(cache_path, ignore_errors=True)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            if not os.path.exists(os.path.join(cache_path, "meta.json")):
+                raise
+            shutil.rmtree(tmp_path, ignore_errors=True)  # built by another run in the meantime
+
+    def __len__(self):
+        return len(self.intent_ids)
+
+    def __getitem__(self, idx):
+        return self.intent_ids[idx], self.utter_ids[idx], idx
+
+
 # evaluation of predicted text outputs
 class ComparisonDataset(Dataset):
     """ For evaluating outputs and targets
@@ -114,65 +228,264 @@ class ComparisonDataset(Dataset):
 ###########################
 #    Collate Functions    #
 ###########################
-def enc_dec_collate_fn(data, tokenizer, max_intent_len, max_utter_len):
+IGNORE_INDEX = -100  # label of the pad positions, ignored by the losses
+
+
+def pad_ids(seqs, pad_token_id):
+    """ pad a list of 1-d token id arrays to the longest one """
+    padded = np.full((len(seqs), max(len(seq) for seq in seqs)), pad_token_id, dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        padded[i, :len(seq)] = seq
+    return torch.from_numpy(padded)
+
+
+def enc_dec_collate_fn(data, pad_token_id):
     """ Encoder-Decode model collate function
     Arg:
-        data (List[Tuple[intent_str, utter_str]): One batch/list of data tuples. Each tuple contains un-tokenized
-            intention string and utterance string.
+        data (List[Tuple[intent_ids, utter_ids, example_id]): One batch/list of data tuples. Each tuple contains
+            the pre-tokenized (already truncated to max_xxx_len) intention and utterance token ids.
     Return:
-        token ids padded to the length of the longest sequence in the batch; truncated to max_xxx_len
+        token ids padded to the length of the longest sequence in the batch
         inputs: padded_intents_ids
-        labels: padded_utterances_ids
+        labels: padded_utterances_ids, padded with IGNORE_INDEX, so that a loss does not depend on the batch
+        example_ids: index of each example in the dataset
     """
-    intents, utterances = zip(*data)  # unzip data
-    padded_intents_ids = tokenizer(intents, padding='longest', truncation=True,
-                                   max_length=max_intent_len)['input_ids']
-    padded_utterances_ids = tokenizer(utterances, padding='longest', truncation=True,
-                                      max_length=max_utter_len)['input_ids']
-    return torch.LongTensor(padded_intents_ids), torch.LongTensor(padded_utterances_ids)
+    intent_ids, utter_ids, example_ids = zip(*data)  # unzip data
+    return pad_ids(intent_ids, pad_token_id), pad_ids(utter_ids, IGNORE_INDEX), torch.LongTensor(example_ids)
+
+
+###########################
+#     Batch Samplers      #
+###########################
+def padding_ratio(batches, src_lengths, tgt_lengths):
+    """ fraction of pad tokens in the padded src and tgt tensors of the given batches """
+    real_tokens, padded_tokens = 0, 0
+    for batch in batches:
+        for lengths in (src_lengths[batch], tgt_lengths[batch]):
+            real_tokens += lengths.sum()
+            padded_tokens += lengths.max() * len(batch)
+    return 1 - real_tokens / padded_tokens if padded_tokens > 0 else 0.0
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Group examples with similar tokenized intent/utterance lengths into the same batch to reduce padding.
+    shuffle=True: examples are shuffled and split into pools of `pool_size` batches. Each pool is sorted by
+        length and cut into batches, then the order of all batches is shuffled. Re-sampled every epoch.
+    shuffle=False: examples are sorted by length over the whole dataset. The order is deterministic.
+        If sort_window > 0, only within consecutive windows of `sort_window` batches in dataset order, so that
+        a consumer restoring the dataset order (e.g. the streaming decode writer) buffers at most one window.
+    indices: only batch these dataset indices (e.g. a curriculum). Lengths are those of the whole dataset.
+    """
+    def __init__(self, src_lengths, tgt_lengths, batch_size, shuffle=True, pool_size=50, indices=None, sort_window=0):
+        self.src_lengths = np.asarray(src_lengths)
+        self.tgt_lengths = np.asarray(tgt_lengths)
+        self.indices = np.arange(len(self.src_lengths)) if indices is None else np.asarray(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.sort_window = sort_window
+
+    def sort_by_length(self, indices):
+        return indices[np.lexsort((self.tgt_lengths[indices], self.src_lengths[indices]))]
+
+    def split(self, indices):
+        """ cut length-sorted indices into batches """
+        return [indices[i: i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+
+    def split_pools(self, indices, pool_size):
+        """ sort each pool of `pool_size` batches of consecutive indices by length and cut it into batches """
+        pool = self.batch_size * pool_size
+        batches = []
+        for start in range(0, len(indices), pool):
+            batches.extend(self.split(self.sort_by_length(indices[start: start + pool])))
+        return batches
+
+    def get_batches(self, generator=None):
+        """ generator (torch.Generator): for the shuffling. Default: the global torch RNG """
+        n_example = len(self.indices)
+        if not self.shuffle:
+            if self.sort_window > 0:
+                return self.split_pools(self.indices, self.sort_window)
+            return self.split(self.sort_by_length(self.indices))
+
+        indices = self.indices[torch.randperm(n_example, generator=generator).numpy()]
+        batches = self.split_pools(indices, self.pool_size)
+        return [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+    def padding_ratio(self):
+        """ of one epoch sampled with a private generator: logging it does not change the global random streams """
+        return padding_ratio(self.get_batches(torch.Generator().manual_seed(0)), self.src_lengths, self.tgt_lengths)
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    """
+    Length-bucketed batches that hold as many examples as fit into a token budget, i.e.
+    num_examples * (max src len + max tgt len) <= max_tokens. An example over the budget is batched alone.
+    batch_size only sets the size of the shuffling pools.
+    The number of batches varies between epochs, so the next epoch is sampled when its length is queried.
+    """
+    def __init__(self, src_lengths, tgt_lengths, max_tokens, batch_size, shuffle=True, pool_size=50, indices=None):
+        super().__init__(src_lengths, tgt_lengths, batch_size, shuffle, pool_size, indices)
+        self.max_tokens = max_tokens
+        self.next_batches = None
+
+    def split(self, indices):
+        batches, batch, max_src, max_tgt = [], [], 0, 0
+        for idx in indices.tolist():
+            src_len, tgt_len = max(max_src, self.src_lengths[idx]), max(max_tgt, self.tgt_lengths[idx])
+            if batch and (len(batch) + 1) * (src_len + tgt_len) > self.max_tokens:
+                batches.append(batch)
+                batch, src_len, tgt_len = [], self.src_lengths[idx], self.tgt_lengths[idx]
+            batch.append(idx)
+            max_src, max_tgt = src_len, tgt_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        batches = self.next_batches if self.next_batches is not None else self.get_batches()
+        self.next_batches = None
+        return iter(batches)
+
+    def __len__(self):
+        if self.next_batches is None:
+            self.next_batches = self.get_batches()
+        return len(self.next_batches)
+
+
+def get_sample_order(dataloader):
+    """ dataset indices in the order that a non-shuffling dataloader yields its samples """
+    return [idx for batch in dataloader.batch_sampler for idx in batch]
+
+
+def restore_order(values, order):
+    """ reorder per-sample values yielded in dataloader order by ascending dataset index """
+    return [values[i] for i in np.argsort(order, kind='stable')]
 
 
 ###########################
 #  Construct DataLoader   #
 ###########################
-def get_dataset(data_file, tgt_file, data_cache_dir, overwrite_cache):
+def tokenizer_hash(tokenizer):
+    """ hash of the tokenizer vocab, so that caches are not shared across vocabs """
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    return hashlib.md5(vocab.encode('utf-8')).hexdigest()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def remove_stale_caches(data_cache_dir, filename, meta, data_cache_path):
+    """ delete caches built from the same src/tgt paths whose file contents have changed since """
+    for cache_path in glob.glob(os.path.join(data_cache_dir, f"{filename}.*")):
+        meta_path = os.path.join(cache_path, "meta.json")
+        if cache_path == data_cache_path or ".tmp." in os.path.basename(cache_path) or not os.path.exists(meta_path):
+            continue
+        with open(meta_path, 'r') as f:
+            old_meta = json.load(f)
+        same_files = all(old_meta.get(k) == meta[k] for k in ["src_file", "tgt_file"])
+        same_content = all(old_meta.get(k) == meta[k] for k in ["src_hash", "tgt_hash"])
+        if same_files and not same_content:
+            logging.info("Removing stale data cache %s", cache_path)
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+
+def get_dataset(args, tokenizer, data_file, tgt_file):
+    """ Load the tokenized dataset from the cache, or build and cache it.
+    The cache is keyed by the src/tgt paths and contents and the preprocessing params,
+    so it is invalidated automatically and can be shared by runs with different data in one data_cache_dir.
+    """
+    meta = {
+        "src_file": os.path.abspath(data_file),
+        "tgt_file": os.path.abspath(tgt_file),
+        "src_hash": file_hash(data_file),
+        "tgt_hash": file_hash(tgt_file),
+        "tokenizer": tokenizer_hash(tokenizer),
+        "max_intent_len": args.max_intent_len,
+        "max_utter_len": args.max_utter_len,
+    }
+    key = hashlib.md5(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()[:16]
     filename = os.path.splitext(os.path.basename(data_file))[0]
-    data_cache_path = os.path.join(data_cache_dir, filename + ".bin")
-    if not overwrite_cache and os.path.exists(data_cache_path):
+    data_cache_path = os.path.join(args.data_cache_dir, f"{filename}.{key}")
+    remove_stale_caches(args.data_cache_dir, filename, meta, data_cache_path)
+
+    if not args.overwrite_cache and os.path.exists(os.path.join(data_cache_path, "meta.json")):
         logging.info("Loading processed data from cached dir %s", data_cache_path)
-        dataset = MultiwozSgdDataset.from_bin_file(data_cache_path)
+        dataset = TokenizedDataset.from_cache(data_cache_path)
     else:
         logging.info("Creating features from dataset file at %s. Caching to %s.",
-                     data_file, data_cache_dir)
-        dataset = MultiwozSgdDataset.from_txt_file(data_file, data_cache_dir, tgt_file=tgt_file)
+                     data_file, data_cache_path)
+        raw_dataset = MultiwozSgdDataset.from_txt_file(data_file, tgt_file=tgt_file)
+        dataset = TokenizedDataset.from_dataset(raw_dataset, tokenizer, args.max_intent_len, args.max_utter_len)
+        dataset.cache(data_cache_path, meta, overwrite=args.overwrite_cache)
+        dataset = TokenizedDataset.from_cache(data_cache_path)
     return dataset
 
 
 def get_collate_fn(args, tokenizer):
-    fn = partial(enc_dec_collate_fn, tokenizer=tokenizer,
-                 max_intent_len=args.max_intent_len, max_utter_len=args.max_utter_len)
+    fn = partial(enc_dec_collate_fn, pad_token_id=tokenizer.pad_token_id)
     return fn
 
 
-def get_data_loader(args, tokenizer, data_file, tgt_file, batch_size, sampler_class):
-    dataset = get_dataset(data_file, tgt_file, args.data_cache_dir, args.overwrite_cache)
-    sampler = sampler_class(dataset)
-    collate_fn = get_collate_fn(args, tokenizer)
-    dataloader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn, drop_last=False)
-    return dataloader, len(dataset)
+def build_data_loader(dataset, batch_size, sampler_class, collate_fn, bucket_batching=False, max_tokens=0,
+                      indices=None, sort_window=0):
+    """
+    bucket_batching: batch by length with a BucketBatchSampler instead of sampler_class.
+        Shuffles iff sampler_class is RandomSampler.
+    max_tokens: if > 0, batch by length with a TokenBudgetBatchSampler of max_tokens src+tgt tokens per batch.
+    indices: only load these dataset indices (np.ndarray), in this order if not shuffled.
+    sort_window: bucket_batching without shuffling sorts by length only within windows of this many batches.
+        0: over all the indices.
+    """
+    shuffle = sampler_class is RandomSampler
+    if not bucket_batching and max_tokens <= 0:
+        if indices is None:
+            sampler = sampler_class(dataset)
+        else:
+            sampler = SubsetRandomSampler(indices) if shuffle else indices.tolist()
+        return DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn, drop_last=False)
+
+    src_lengths, tgt_lengths = dataset.intent_ids.lengths(), dataset.utter_ids.lengths()
+    if max_tokens > 0:
+        batch_sampler = TokenBudgetBatchSampler(src_lengths, tgt_lengths, max_tokens, batch_size, shuffle=shuffle,
+                                                indices=indices)
+        logging.info("  Max tokens per batch = %d, Num batches = %d", max_tokens, len(batch_sampler))
+    else:
+        batch_sampler = BucketBatchSampler(src_lengths, tgt_lengths, batch_size, shuffle=shuffle, indices=indices,
+                                           sort_window=sort_window)
+    indices = batch_sampler.indices
+    if shuffle:
+        indices = indices[np.random.RandomState(0).permutation(len(indices))]  # not the global RNG, as above
+    unbucketed = [indices[i: i + batch_size] for i in range(0, len(indices), batch_size)]
+    logging.info("  Padding ratio = %.4f (%.4f without bucket batching)", batch_sampler.padding_ratio(),
+                 padding_ratio(unbucketed, src_lengths, tgt_lengths))
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
 
 
-def get_data_loader_from_dataset(args, dataset, tokenizer, batch_size, sampler_class):
-    sampler = sampler_class(dataset)
-    collate_fn = get_collate_fn(args, tokenizer)
-    dataloader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn, drop_last=False)
-    return dataloader, len(dataset)
+def get_data_loader(args, tokenizer, data_file, tgt_file, batch_size, sampler_class, sort_window=0):
+    dataset = get_dataset(args, tokenizer, data_file, tgt_file)
+    return get_data_loader_from_dataset(args, dataset, tokenizer, batch_size, sampler_class, sort_window=sort_window)
 
 
-def get_comp_dataloader(output_file, tgt_file, batch_size):
-    dataset = ComparisonDataset(output_file, tgt_file)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
-    return dataloader, len(dataset)
+def get_data_loader_from_dataset(args, dataset, tokenizer, batch_size, sampler_class, indices=None, sort_window=0):
+    """ indices: only load these dataset indices. sort_window: see build_data_loader """
+    collate_fn = get_collate_fn(args, tokenizer)
+    max_tokens = args.max_tokens_per_batch if sampler_class is RandomSampler else 0  # token budget for training only
+    dataloader = build_data_loader(dataset, batch_size, sampler_class, collate_fn, args.bucket_batching, max_tokens,
+                                   indices, sort_window)
+    return dataloader, len(dataset) if indices is None else len(indices)
 
 
 ###########################
@@ -181,13 +494,12 @@ if __name__ == "__main__":
     from transformers import T5Tokenizer
 
     train_file = "../data/restaurant/new.txt"
-    cache_path = "../data_cached/restaurant/new.bin"
 
     t5_tokenizer = T5Tokenizer.from_pretrained('t5-small')
-    dataset = FewShotWozDataset.from_txt_file(train_file, cache_path, '&', )
+    raw_dataset = FewShotWozDataset.from_txt_file(train_file, '&', )
+    dataset = TokenizedDataset.from_dataset(raw_dataset, t5_tokenizer, max_intent_len=40, max_utter_len=60)
     dataloader = DataLoader(dataset, batch_size=5, shuffle=True, sampler=None,
-                            collate_fn=partial(enc_dec_collate_fn, tokenizer=t5_tokenizer,
-                                               max_intent_len=40, max_utter_len=60))
+                            collate_fn=partial(enc_dec_collate_fn, pad_token_id=t5_tokenizer.pad_token_id))
 
     for batch in dataloader:
         print(len(batch))  # 2
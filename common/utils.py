@@ -2,12 +2,18 @@
 import argparse
 import os
 import re
+import json
+import copy
+import fcntl
 import shutil
+import contextlib
 import glob
 import random
 import torch
 import logging
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 def set_seed(seed):
@@ -16,6 +22,25 @@ def set_seed(seed):
     torch.manual_seed(seed)
 
 
+def get_rng_state():
+    """ states of the python, numpy and torch (+ cuda) RNGs. Only tensors and python types, for torch.save """
+    np_state = np.random.get_state()
+    return {
+        "python": random.getstate(),
+        "numpy": (np_state[0], torch.from_numpy(np_state[1].copy())) + tuple(np_state[2:]),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state((state["numpy"][0], state["numpy"][1].numpy()) + tuple(state["numpy"][2:]))
+    torch.set_rng_state(state["torch"])
+    if state["cuda"]:
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
 def init_arg_parser():
     parser = argparse.ArgumentParser()
 
@@ -45,7 +70,12 @@ def init_arg_parser():
 
     # Training schedule details
     parser.add_argument("--train_batch_size", default=1, type=int, help="Training batch size of DataLoader")
+    parser.add_argument("--max_tokens_per_batch", default=0, type=int,
+                        help="If > 0, pack training batches up to this many padded src+tgt tokens instead of "
+                             "using a fixed train_batch_size (which then only sets the length-sorting pool size)")
     parser.add_argument("--train_patience", default=-1, type=int, help="Max epoch without improvements")
+    parser.add_argument("--log_every_n_steps", default=1, type=int,
+                        help="Record one (example-weighted mean) batch loss per this many steps in the history")
     parser.add_argument('--overwrite_output_dir', default=False, action='store_true',
                         help="Overwrite the content of the output directory")
     # parser.add_argument("--valid_every_epoch", default=10, type=int,
@@ -62,6 +92,10 @@ def init_arg_parser():
                         help="Weight decay if we apply some.")
     parser.add_argument("--adam_epsilon", default=1e-8, type=float,
                         help="Epsilon for Adam optimizer.")
+    parser.add_argument("--gradient_accumulation_steps", default=1, type=int,
+                        help="Number of micro-batches to accumulate gradients over before an optimizer step.")
+    parser.add_argument("--bf16", default=False, action='store_true',
+                        help="Train with bf16 autocast (mixed precision). Needs torch >= 1.10.")
     parser.add_argument("--max_grad_norm", default=1.0, type=float,
                         help="Max gradient norm.")
     parser.add_argument("--num_train_epochs", default=1.0, type=float,
@@ -74,14 +108,31 @@ def init_arg_parser():
     ### Curriculum ###
     parser.add_argument("--curriculum_name", default="NC", type=str, help="[NC, one_pass, baby_step]")
     parser.add_argument("--curriculum_num_bucket", default=5, type=int, help="Num of curriculum buckets.")
+    parser.add_argument("--curriculum_scorer", default="intent_slot", type=str,
+                        help="Difficulty scorer of the bucket curricula. [length, intent_count, slot_count, "
+                             "intent_slot, rarity, baseline_loss, baseline_bleu, baseline_accu]. The baseline_* "
+                             "scorers use the per-sample metrics of the --dcl_baseline model.")
 
     # Dynamic CL
-    parser.add_argument("--dcl_baseline", default="", type=str, help="Trained baseline model for dynamic CL")
+    parser.add_argument("--dcl_baseline", default="", type=str,
+                        help="Trained baseline model for dynamic CL. Its per-sample metrics on the training set "
+                             "are cached in its sample_metrics dir.")
     parser.add_argument("--dcl_phase", default=5, type=int, help="Num of phases for dynamic CL.")
     parser.add_argument("--dcl_a", default=1, type=int, help="Num of warming-up phases for dynamic CL.")
     parser.add_argument("--dcl_c0", default=0.2, type=float, help="Percentage of the training set to be included in the first phase")
     parser.add_argument("--dcl_alpha", default=0.3, type=float, help="Weight of slot accuracy against BLEU when calculating model competence")
     parser.add_argument("--dcl_beta", default=0.9, type=float, help="Model competence measure hyper-param.")
+    parser.add_argument("--dcl_corpus_bleu", default=False, action='store_true',
+                        help="Measure the model competence with corpus BLEU instead of the average sentence BLEU.")
+    parser.add_argument("--dcl_refresh_ratio", default=1.0, type=float,
+                        help="Fraction of the stale sample losses (not trained on in the last phase) re-computed "
+                             "at the start of each phase. The other sample losses are recorded during training "
+                             "(in train mode, so with dropout).")
+    parser.add_argument("--dcl_full_loss_pass", default=False, action='store_true',
+                        help="Re-compute the loss of every training sample at the start of each phase.")
+    parser.add_argument("--dcl_mmap_min_samples", default=1000000, type=int,
+                        help="Keep the per-phase sample losses in a memory-mapped file in output_dir "
+                             "if the training set has at least this many samples.")
 
     ### Dev ###
     parser.add_argument("--dev_data_file", default="", type=str,
@@ -92,13 +143,35 @@ def init_arg_parser():
     ### Decoding ###
     parser.add_argument('--decode_input_file', type=str, default=None, help="File to be decoded")
     parser.add_argument('--decode_tgt_file', type=str, default=None)
-    parser.add_argument('--decode_output_file', type=str, default=None, help="Decoded utterance strings")
+    parser.add_argument('--decode_output_file', type=str, default=None,
+                        help="Decoded utterance strings. Default: output_dir/results.txt")
     parser.add_argument("--decode_batch_size", default=20, type=int, help="Batch size for decoding.")
+    parser.add_argument('--decode_no_loss', default=False, action='store_true',
+                        help="Only generate utterances. Skip the teacher-forced loss and perplexity.")
+    parser.add_argument('--decode_scores', default=False, action='store_true',
+                        help="Also write the teacher-forced loss of each decoded line to <decode output>.scores")
+    parser.add_argument('--decode_sort_window', default=8, type=int,
+                        help="With --bucket_batching, sort the decode set by length only within windows of this "
+                             "many batches, which bounds the decoded lines held back to restore the file order. "
+                             "0 = sort the whole set")
+    parser.add_argument('--decode_resume', default=False, action='store_true',
+                        help="Continue an interrupted decoding: keep the lines already written to the decode output "
+                             "and only decode the rest")
 
     ### Evaluating ###
     parser.add_argument('--eval_output_file', type=str, default=None, help="Decoded text file.")
     parser.add_argument('--eval_tgt_file', type=str, default=None, help="Targeted utterances.")
-    parser.add_argument("--eval_batch_size", default=20, type=int, help="Batch size for decoding.")
+    parser.add_argument("--eval_batch_size", default=256, type=int,
+                        help="Number of (output, target) pairs per work unit of the evaluation workers.")
+    parser.add_argument("--eval_num_workers", default=0, type=int,
+                        help="Processes scoring sentence BLEU and METEOR. 0 for one per CPU, 1 for no worker.")
+    parser.add_argument('--bleurt_checkpoint', type=str, default=None,
+                        help="BLEURT checkpoint. Defaults to BLEURT-tiny if not specified.")
+    parser.add_argument("--bleurt_batch_size", default=128, type=int,
+                        help="Number of (reference, candidate) pairs per BLEURT predictor call.")
+    parser.add_argument('--bleurt_length_batching', default=False, action='store_true',
+                        help="Sort pairs by length and trim padding per BLEURT batch. "
+                             "Requires a checkpoint with dynamic_seq_length.")
 
     # parser.add_argument("--top_k", type=int, default=0)
     # parser.add_argument("--top_p", type=float, default=0.9)
@@ -118,10 +191,13 @@ def init_arg_parser():
     ### Data Processing ###
     # TODO: these options all related to data loading?
     parser.add_argument('--overwrite_cache', default=False, action='store_true',
-                        help="Overwrite the cached processed dataset for training and evaluation")
+                        help="Rebuild the cached processed dataset for training and evaluation. "
+                             "Not needed when the data files change: the cache is keyed by their content.")
     parser.add_argument('--data_cache_dir', default="", type=str, help="Dir to cache preprocessed data bin file")
     parser.add_argument('--max_intent_len', default=40, type=int, help="Max intention length (for EncDec model)")
     parser.add_argument('--max_utter_len', default=60, type=int, help="Max utterance length (for EncDec model)")
+    parser.add_argument('--bucket_batching', default=False, action='store_true',
+                        help="Batch examples of similar token lengths together to reduce padding")
 
     # parser.add_argument('--max_len', default=80, type=int, help="Max raw sentence length (for LM model)")
     # parser.add_argument('--text_chunk', default=False, action='store_true',
@@ -133,21 +209,31 @@ def init_arg_parser():
     # parser.add_argument("--max_seq", default=80, type=int,
     #                     help="Max num tokens when loading text (including tokens for both code and utterance)")
 
-    # ### Logging and save ###
+    ### Logging and save ###
     # parser.add_argument('--logging_steps', type=int, default=100, help="Log every X updates steps.")
     # parser.add_argument('--save_steps', type=int, default=5000, help="Save checkpoint every X updates steps.")
-    # parser.add_argument('--save_total_limit', type=int, default=None,
-    #                     help='Limit the total amount of checkpoints, delete the older checkpoints in the output_dir, '
-    #                          'does not delete by default')
+    parser.add_argument('--save_total_limit', type=int, default=None,
+                        help="Also keep the last X saved checkpoints as output_dir/checkpoint-N, "
+                             "deleting the older ones. Does not keep them by default")
+    parser.add_argument('--max_pending_saves', type=int, default=1,
+                        help="Max number of checkpoints being written in the background. "
+                             "Training waits when the limit is hit. 0 = save synchronously")
+    parser.add_argument('--save_training_state', default=False, action='store_true',
+                        help="After every epoch, also save the full training state (optimizer, curriculum phase, "
+                             "RNG states, ...) to output_dir/training_state.pt, to be resumed with --resume_from")
+    parser.add_argument('--resume_from', default="", type=str,
+                        help="training_state.pt (or the output dir holding it) to resume training from, at the "
+                             "epoch after the saved one and with the same batch order. Use the same arguments and "
+                             "output_dir as the interrupted run")
     # parser.add_argument("--eval_all_checkpoints", default=False, action='store_true',
     #                     help="Evaluate all checkpoints starting with the same prefix as model_name or model_path "
     #                          "and ending with step number. When false, only evaluate the model in model_path")
     return parser
 
 
-def check_config(parser):
-    """ Perform sanity checks on command line parsed arguments"""
-    args = parser.parse_args()
+def check_config(parser, argv=None):
+    """ Perform sanity checks on command line parsed arguments (or on argv, e.g. from run_grid.py) """
+    args = parser.parse_args(argv)
 
     ### generic config ###
     set_seed(args.seed)
@@ -168,9 +254,20 @@ def check_config(parser):
     else:
         args.model_loc = ""
 
+    ### training precision ###
+    if args.bf16 and not hasattr(torch, "autocast"):
+        raise ValueError("--bf16 requires torch.autocast (torch >= 1.10).")
+    if args.gradient_accumulation_steps < 1:
+        raise ValueError("--gradient_accumulation_steps must be >= 1.")
+    if args.log_every_n_steps < 1:
+        raise ValueError("--log_every_n_steps must be >= 1.")
+    if args.decode_scores and args.decode_no_loss:
+        raise ValueError("--decode_scores needs the teacher-forced loss: drop --decode_no_loss.")
+
     ### mode ###
     if args.mode == 'train':
-        if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and not args.overwrite_output_dir:
+        if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and not args.overwrite_output_dir \
+                and not args.resume_from:
             raise ValueError("Output directory ({}) already exists and is not empty. Use "
                              "--overwrite_output_dir to overcome.".format(args.output_dir))
     return args
@@ -204,12 +301,68 @@ def rotate_checkpoints(args, checkpoint_prefix, use_mtime=False):
         shutil.rmtree(checkpoint)
 
 
+@contextlib.contextmanager
+def file_lock(path):
+    """ exclusive lock between processes (e.g. the cells of run_grid.py) on the file `path`, created if missing """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def load_checkpoint(model_loc, model_class, tokenizer_class):
     model = model_class.from_pretrained(model_loc)
     tokenizer = tokenizer_class.from_pretrained(model_loc)
     return model, tokenizer
 
 
+def load_shared_checkpoint(model_loc, model_class, tokenizer_class):
+    """
+    load_checkpoint with the model weights moved to shared memory. Processes the model is passed to
+    (e.g. multiprocessing workers) map the same pages instead of each deserializing a private copy.
+    The shared weights must stay read-only: train on a copy.deepcopy of the model.
+    """
+    model, tokenizer = load_checkpoint(model_loc, model_class, tokenizer_class)
+    model.share_memory()
+    return model, tokenizer
+
+
+def model_size(model):
+    """ bytes of the model parameters and buffers """
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def process_memory():
+    """ resident memory of this process in bytes: {"anon": private, "shmem": shared memory}. Linux only, else {} """
+    fields = {"RssAnon:": "anon", "RssShmem:": "shmem"}
+    memory = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.split()[0] in fields:
+                    memory[fields[line.split()[0]]] = int(line.split()[1]) * 1024
+    except (OSError, IndexError):
+        return {}
+    return memory
+
+
+def cpu_state_dict(model):
+    """
+    Host copy of the model state_dict. Tensors that alias the same memory (e.g. the tied embeddings of T5) are copied
+    once and stay aliases, so that save_pretrained still writes them once.
+    """
+    copies = {}  # (data_ptr, shape, stride): copy
+    state_dict = {}
+    for k, v in model.state_dict().items():
+        key = (v.data_ptr(), v.shape, v.stride())
+        if key not in copies:
+            copies[key] = v.detach().to("cpu", copy=True)
+        state_dict[k] = copies[key]
+    return state_dict
+
+
 def save_checkpoint(output_dir, model, tokenizer, args):
     # if you use save_pretrained for the model and tokenizer,
     # you can reload them using from_pretrained()
@@ -218,3 +371,176 @@ def save_checkpoint(output_dir, model, tokenizer, args):
     model.save_pretrained(output_dir)
     tokenizer.save_pretrained(output_dir)
     torch.save(args, os.path.join(output_dir, 'training_args.bin'))
+
+
+class CheckpointWriter(object):
+    """
+    Save checkpoints on a background thread so that training is not stalled on disk I/O.
+    The model state_dict is snapshotted to host memory before returning, then serialized on the worker thread
+    into a tmp dir whose files are atomically renamed into output_dir.
+    At most args.max_pending_saves saves are in flight (each holds one host copy of the weights).
+    If args.save_total_limit is set, each save is also kept as output_dir/checkpoint-N and older ones are rotated.
+    """
+    checkpoint_prefix = "checkpoint"
+
+    def __init__(self, args):
+        self.max_pending = args.max_pending_saves
+        self.keep_checkpoints = bool(args.save_total_limit and args.save_total_limit > 0)
+        self.executor = ThreadPoolExecutor(max_workers=1) if self.max_pending > 0 else None
+        self.pending = deque()
+        self.num_saves = 0
+
+    def save(self, output_dir, model, tokenizer, args):
+        state_dict = cpu_state_dict(model)
+        args = copy.copy(args)
+        self.num_saves += 1
+        if self.executor is None:
+            self.write(output_dir, self.num_saves, model, state_dict, tokenizer, args)
+            return
+
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()  # re-raises errors of the worker
+        self.pending.append(self.executor.submit(self.write, output_dir, self.num_saves, model, state_dict,
+                                                 tokenizer, args))
+
+    def write(self, output_dir, save_idx, model, state_dict, tokenizer, args):
+        tmp_dir = os.path.join(output_dir, f".{self.checkpoint_prefix}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        model.save_pretrained(tmp_dir, state_dict=state_dict)
+        tokenizer.save_pretrained(tmp_dir)
+        torch.save(args, os.path.join(tmp_dir, 'training_args.bin'))
+
+        if self.keep_checkpoints:
+            shutil.copytree(tmp_dir, os.path.join(output_dir, f"{self.checkpoint_prefix}-{save_idx}"))
+            rotate_checkpoints(args, self.checkpoint_prefix)
+        for filename in os.listdir(tmp_dir):
+            os.replace(os.path.join(tmp_dir, filename), os.path.join(output_dir, filename))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def wait(self):
+        """ block until all pending saves are on disk """
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def state_dict(self):
+        self.wait()  # the saves counted in a training state are on disk
+        return {"num_saves": self.num_saves}
+
+    def load_state_dict(self, state):
+        self.num_saves = state["num_saves"]
+
+
+class HistoryLog(object):
+    """
+    Append-only training history in output_dir/history.jsonl, flushed after every epoch.
+    One JSON record per line:
+        {"type": "batch", "curriculum": c, "batch_losses": float, "batch_ex_seen": int}
+        {"type": "epoch", "curriculum": c, "epoch_losses": float, "epoch_ex_seen": int[, "neg_bleu", "slot_accu"]}
+    curriculum: index of the curriculum / phase (the outer list of the old history.json), set by next_curriculum().
+    append: keep the existing records (when resuming training), instead of starting a new file
+    """
+    def __init__(self, path, append=False):
+        self.path = path
+        self.fp = open(path, 'a' if append else 'w', encoding='utf-8')
+        self.curriculum = -1
+
+    def next_curriculum(self):
+        self.curriculum += 1
+
+    def log(self, record_type, **values):
+        record = {"type": record_type, "curriculum": self.curriculum}
+        record.update(values)
+        self.fp.write(json.dumps(record) + "\n")
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+    def state_dict(self):
+        self.flush()
+        return {"curriculum": self.curriculum, "offset": self.fp.tell()}
+
+    def load_state_dict(self, state):
+        """ drop the records written after the state was saved """
+        self.curriculum = state["curriculum"]
+        self.flush()
+        if self.fp.tell() >= state["offset"]:
+            self.fp.truncate(state["offset"])
+            self.fp.seek(state["offset"])
+
+
+class TrainingState(object):
+    """
+    Everything needed to resume training after an epoch with the same batch order as an uninterrupted run:
+    the position (curriculum / DCL phase index and next epoch), the model and optimizer states, the loop variables
+    of train_with_dataloader, the RNG states and the states of the registered components
+    (objects with state_dict() / load_state_dict(), e.g. SplRegularizer, PhaseLossBuffer, HistoryLog).
+    With args.save_training_state, atomically written to output_dir/training_state.pt after every epoch.
+    With args.resume_from, loaded at init: callers skip the curricula before the resumed one, and
+    train_with_dataloader restores the rest with restore() on the resumed one.
+    """
+    filename = "training_state.pt"
+
+    def __init__(self, args):
+        self.path = os.path.join(args.output_dir, self.filename) if args.save_training_state else None
+        self.curriculum_name = args.curriculum_name
+        self.components = {}
+        self.resumed = None
+        if args.resume_from:
+            path = args.resume_from
+            if os.path.isdir(path):
+                path = os.path.join(path, self.filename)
+            self.resumed = torch.load(path, map_location="cpu")
+            if self.resumed["curriculum_name"] != args.curriculum_name:
+                raise ValueError(f"Cannot resume {args.curriculum_name} training from the state of "
+                                 f"{self.resumed['curriculum_name']} training ({path}).")
+            logging.info("Resuming training from %s: curriculum %d, epoch %d", path, self.resumed["curriculum"] + 1,
+                         self.resumed["loop"]["next_epoch"] + 1)
+
+    def register(self, name, component):
+        self.components[name] = component
+
+    def skip(self, curriculum):
+        """ whether the curriculum was finished before the resumed one """
+        return self.resumed is not None and curriculum < self.resumed["curriculum"]
+
+    def resumes_at(self, curriculum):
+        return self.resumed is not None and curriculum == self.resumed["curriculum"]
+
+    def load_components(self):
+        for name, component in self.components.items():
+            component.load_state_dict(self.resumed["components"][name])
+
+    def restore(self, model, optimizer):
+        """ restore the resumed state and stop resuming. return: loop variables of train_with_dataloader """
+        self.load_components()
+        state, self.resumed = self.resumed, None
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        set_rng_state(state["rng"])
+        return state["loop"]
+
+    def save(self, curriculum, model, optimizer, loop):
+        """ loop: loop variables of train_with_dataloader, incl. next_epoch """
+        if self.path is None:
+            return
+        state = {
+            "curriculum_name": self.curriculum_name,
+            "curriculum": curriculum,
+            "loop": loop,
+            "model": cpu_state_dict(model),
+            "optimizer": optimizer.state_dict(),
+            "components": {name: component.state_dict() for name, component in self.components.items()},
+            "rng": get_rng_state(),
+        }
+        tmp_path = self.path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.path)
@@ -2,17 +2,46 @@ import os
 import re
 import json
 import torch
+import hashlib
 import logging
+import numpy as np
 from tqdm import tqdm
-from collections import defaultdict
-
-from torch.nn import CrossEntropyLoss
-from nltk.translate.meteor_score import meteor_score
-import sacrebleu
-import bleurt.score
-from common.utils import load_checkpoint
-from common.data import get_data_loader, get_comp_dataloader
+from fnmatch import fnmatch
+from collections import defaultdict, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from importlib import import_module
+from common.utils import load_checkpoint, file_lock
+from common.data import get_data_loader_from_dataset, ComparisonDataset, get_sample_order, \
+    restore_order, file_hash, IGNORE_INDEX
+from components.generate import generate_with_loss, get_attention_mask, calc_sample_losses
+from torch.utils.data import SequentialSampler
 BINARY_ANS = ['none', 'yes', 'no', 'false', 'true']
+BLEURT_POOL_SIZE = 2  # max number of loaded BLEURT checkpoints kept per process
+SAMPLE_METRICS_DIR = "sample_metrics"  # per-sample metric cache, inside the baseline checkpoint dir
+SV_PATTERN = re.compile(r".*\((.*)\)")  # slot-value pair of one intent
+CHECKPOINT_FILES = ["config.json", "*.safetensors", "pytorch_model*.bin", "spiece.model", "tokenizer*.json",
+                    "special_tokens_map.json"]
+
+
+###################
+# metric backends #
+###################
+# Imported on first use, so that runs which never compute a metric don't pay for its imports
+# (e.g. TensorFlow for BLEURT).
+METRIC_BACKENDS = {
+    "sacrebleu": "sacrebleu",
+    "tokenizer_13a": "sacrebleu.tokenizers.tokenizer_13a",
+    "meteor": "nltk.translate.meteor_score",
+    "bleurt": "bleurt.score",
+}
+
+
+def backend(name):
+    """ the module of a metric backend, imported on first use """
+    if name not in METRIC_BACKENDS:
+        raise ValueError(f"Invalid metric backend {name}. Must be in {list(METRIC_BACKENDS)}.")
+    return import_module(METRIC_BACKENDS[name])  # cached in sys.modules after the first call
 
 
 #################
@@ -31,7 +60,6 @@ def parse_intent(src, sv_only=False):
         sv_only=True: (list(tuple))
             [(slot, val), (slot, val), ...]
     """
-    p_sv = re.compile(".*\((.*)\)")
     intents = src.split('|')
     res = [] if sv_only else {"domain": intents[0].strip(), "intent": defaultdict(dict)}
 
@@ -40,7 +68,7 @@ def parse_intent(src, sv_only=False):
         intent = tmp1[0].strip()
 
         try:
-            matched_sv = re.match(p_sv, intent_str).group(1).split('=')
+            matched_sv = SV_PATTERN.match(intent_str).group(1).split('=')
             matched_sv = [token.strip() for token in matched_sv]
         except AttributeError:
             matched_sv = []
@@ -73,14 +101,186 @@ def get_non_bin_sv(slot_val_list):
 
 
 def calc_slot_accu(src, tgt):
-    slot_val_list = parse_intent(src, sv_only=True)
-    non_bin_sv = get_non_bin_sv(slot_val_list)
-    correct = 0
-    for s, v in non_bin_sv:
-        if v in tgt:
-            correct += 1
-    accu = 1 if len(non_bin_sv) == 0 else correct/len(non_bin_sv)
-    return accu
+    return SlotAccuracy().score([tgt], sources=[src])[0]
+
+
+class SlotAccuracy(object):
+    """
+    Slot accuracy engine: the fraction of non-binary slot values of the source that appear in the candidate.
+    Each source is parsed once and its values are cached by key (e.g. the example index, so that they are reused
+    every epoch). Matching is then only substring scans.
+    sources (indexable, optional): source intents of a dataset, looked up by example index
+    """
+    def __init__(self, sources=None):
+        self.sources = sources
+        self.values = {}  # key -> list of non-binary slot values
+
+    def get_values(self, key, src=None):
+        if key not in self.values:
+            src = self.sources[key] if src is None else src
+            self.values[key] = [v for s, v in get_non_bin_sv(parse_intent(src, sv_only=True))]
+        return self.values[key]
+
+    def score(self, candidates, keys=None, sources=None):
+        """
+        candidates (list(str)): generated utterances
+        keys (list): cache key of each source, e.g. the example indices of self.sources. Default: the sources.
+        sources (list(str)): source intents, only needed for the keys missing from the cache
+        return: list(float) slot accuracy of each candidate
+        """
+        keys = sources if keys is None else keys
+        sources = [None] * len(keys) if sources is None else sources
+        accuracies = []
+        for key, src, candidate in zip(keys, sources, candidates):
+            values = self.get_values(key, src)
+            accuracies.append(1 if not values else sum(v in candidate for v in values) / len(values))
+        return accuracies
+
+
+SLOT_ACCURACY_ENGINES = {}  # dataset cache key -> SlotAccuracy keyed by example index
+
+
+def get_slot_accuracy(dataset):
+    """ the slot accuracy engine of a TokenizedDataset, kept across evaluations (e.g. every epoch).
+    Slots are parsed from the raw intent strings of the dataset, not from the decoded (truncated) source ids.
+    """
+    if dataset.cache_key is None:
+        return SlotAccuracy(dataset.intents)
+    if dataset.cache_key not in SLOT_ACCURACY_ENGINES:
+        SLOT_ACCURACY_ENGINES[dataset.cache_key] = SlotAccuracy(dataset.intents)
+    return SLOT_ACCURACY_ENGINES[dataset.cache_key]
+
+
+########
+# BLEU #
+########
+class BleuAccumulator(object):
+    """
+    BLEU sufficient statistics of each sentence, added batch by batch:
+        [hyp_len, ref_len, correct 1..4-grams, total 1..4-grams]
+    Corpus BLEU and sentence BLEU are both computed from them, as sacrebleu.corpus_bleu / sacrebleu.sentence_bleu
+    do with their defaults (13a tokenization, exp smoothing, effective order for sentences).
+    """
+    MAX_ORDER = 4
+
+    def __init__(self):
+        self.tokenize = backend("tokenizer_13a").Tokenizer13a()
+        self.stats = []
+
+    def sentence_stats(self, hypothesis, reference):
+        hyp_tokens = self.tokenize(hypothesis.rstrip()).split()
+        ref_tokens = self.tokenize(reference.rstrip()).split()
+        correct, total = [0] * self.MAX_ORDER, [0] * self.MAX_ORDER
+        for n in range(1, self.MAX_ORDER + 1):
+            hyp_ngrams = Counter(tuple(hyp_tokens[i: i + n]) for i in range(len(hyp_tokens) - n + 1))
+            ref_ngrams = Counter(tuple(ref_tokens[i: i + n]) for i in range(len(ref_tokens) - n + 1))
+            correct[n - 1] = sum((hyp_ngrams & ref_ngrams).values())
+            total[n - 1] = max(len(hyp_tokens) - n + 1, 0)
+        return [len(hyp_tokens), len(ref_tokens)] + correct + total
+
+    def add(self, hypotheses, references):
+        for hypothesis, reference in zip(hypotheses, references):
+            self.stats.append(self.sentence_stats(hypothesis, reference))
+
+    @staticmethod
+    def compute_bleu(stats, effective_order):
+        """
+        stats (np.ndarray[n, 10]): sufficient statistics of n sentences (or of one corpus, summed)
+        return: (np.ndarray[n,]) BLEU of each row
+        """
+        stats = np.asarray(stats, dtype=np.float64).reshape(-1, 2 + 2 * BleuAccumulator.MAX_ORDER)
+        sys_len, ref_len = stats[:, 0], stats[:, 1]
+        correct, total = np.split(stats[:, 2:], 2, axis=1)
+
+        brevity_penalty = np.where(sys_len < ref_len, np.exp(1 - ref_len / np.maximum(sys_len, 1)), 1.0)
+        brevity_penalty[sys_len == 0] = 0.0
+        # orders up to the first one without any hypothesis n-gram
+        valid = np.cumprod(total > 0, axis=1).astype(bool)
+        # exp smoothing: the k-th order without matches gets precision 1 / (2^k * total)
+        no_match = valid & (correct == 0)
+        smooth = np.cumsum(no_match, axis=1)
+        safe_total = np.maximum(total, 1)
+        precisions = np.where(no_match, 100. / (2. ** smooth * safe_total), 100. * correct / safe_total)
+        precisions[~valid] = 0.0
+        log_precisions = np.log(np.maximum(precisions, 1e-300))
+        log_precisions[precisions == 0.0] = -9999999999  # as sacrebleu's floored log
+
+        max_order = BleuAccumulator.MAX_ORDER
+        if effective_order:
+            eff_order = np.maximum(valid.sum(axis=1), 1)
+            in_order = np.arange(max_order)[None, :] < eff_order[:, None]
+            log_mean = np.where(in_order, log_precisions, 0.0).sum(axis=1) / eff_order
+        else:
+            log_mean = log_precisions.sum(axis=1) / max_order
+        scores = brevity_penalty * np.exp(log_mean)
+        scores[correct.sum(axis=1) == 0] = 0.0
+        return scores
+
+    @staticmethod
+    def corpus_bleu(stats):
+        return float(BleuAccumulator.compute_bleu(np.asarray(stats).sum(axis=0), effective_order=False)[0])
+
+    def sentence_scores(self):
+        return self.compute_bleu(self.stats, effective_order=True)
+
+    def sentence_average(self):
+        return float(self.sentence_scores().mean())
+
+    def corpus_score(self):
+        return self.corpus_bleu(self.stats)
+
+
+##########
+# bleurt #
+##########
+class BleurtScorerPool(object):
+    """
+    Process-wide cache of initialized BLEURT scorers, so that the checkpoint config, tokenizer and
+    SavedModel are loaded once per process instead of once per evaluation.
+    key: (checkpoint path, scorer class). The least recently used scorer is closed when the pool is full.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.scorers = OrderedDict()
+
+    def get(self, checkpoint=None, length_batching=False):
+        """
+        Length batching sorts pairs by length and trims each batch to its longest pair
+        instead of padding to max_seq_length. Only for checkpoints with dynamic_seq_length.
+        """
+        bleurt_score = backend("bleurt")
+        scorer_class = bleurt_score.LengthBatchingBleurtScorer if length_batching else bleurt_score.BleurtScorer
+        key = (os.path.abspath(checkpoint) if checkpoint else "", scorer_class.__name__)
+        if key in self.scorers:
+            self.scorers.move_to_end(key)
+            return self.scorers[key]
+
+        while len(self.scorers) >= self.max_size:
+            old_key, old_scorer = self.scorers.popitem(last=False)
+            logging.info(f"Evicting BLEURT scorer {old_key}")
+            old_scorer.close()
+
+        logging.info(f"Loading BLEURT scorer {key}")
+        self.scorers[key] = scorer_class(checkpoint)
+        return self.scorers[key]
+
+    def close(self):
+        """ release all scorers (TF sessions of lazy-mode predictors) """
+        while self.scorers:
+            _, scorer = self.scorers.popitem(last=False)
+            scorer.close()
+
+    def __len__(self):
+        return len(self.scorers)
+
+
+BLEURT_SCORERS = BleurtScorerPool(BLEURT_POOL_SIZE)
+
+
+def calc_bleurt(references, candidates, args):
+    """ score all (reference, candidate) pairs of an eval set in large batches """
+    bleurt_scorer = BLEURT_SCORERS.get(args.bleurt_checkpoint, args.bleurt_length_batching)
+    return bleurt_scorer.score(references=references, candidates=candidates, batch_size=args.bleurt_batch_size)
 
 
 # def evaluate_loss(eval_dataloader, len_eval_dataset, model, args, sentence_loss=False):
@@ -133,53 +333,69 @@ def calc_slot_accu(src, tgt):
 
 def evaluate_data_set(eval_dataloader, model, tokenizer, metrics, args, sentence_level=False):
     """
-    metrics = ['loss', 'bleu', 'accu']
+    metrics = ['loss', 'bleu', 'bleurt', 'accu']
+    'bleu' is the average sentence BLEU. It also returns 'corpus_bleu', or with sentence_level the BLEU
+    statistics of each sentence as 'bleu_stats'.
     """
     model.to(args.device)
     model.eval()
     eval_losses, bleu_scores, bleurt_scores, slot_accuracies = [], [], [], []
-
-    if 'loss' in metrics:
-        loss_fct = CrossEntropyLoss(ignore_index=-100, reduction='none')
-    if 'bleurt' in metrics:
-        bleurt_scorer = bleurt.score.BleurtScorer()
+    bleu = BleuAccumulator() if 'bleu' in metrics else None
+    bleurt_refs, bleurt_cands = [], []  # scored together after decoding
+    accu_indices, accu_cands = [], []
 
     for batch in tqdm(eval_dataloader, desc="Evaluating Metrics"):
-        inputs, labels = batch
+        inputs, labels, indices = batch
         inputs = inputs.to(args.device)
         labels = labels.to(args.device)
 
         with torch.no_grad():
+            if 'bleu' in metrics or 'accu' in metrics or 'bleurt' in metrics:
+                # one encoder pass shared by generation and the teacher-forced loss
+                example_ids, outputs = generate_with_loss(model, inputs, labels, args.max_utter_len,
+                                                          with_loss='loss' in metrics)
+            elif 'loss' in metrics:
+                outputs = model(inputs, attention_mask=get_attention_mask(model, inputs), labels=labels)
+
             if 'loss' in metrics:
-                outputs = model(inputs, labels=labels)
-                tmp_loss = loss_fct(outputs.logits.permute(1, 2, 0), labels.permute(1, 0))
-                sample_losses = torch.mean(tmp_loss, dim=0)
+                sample_losses = calc_sample_losses(outputs.logits, labels)
                 eval_losses.extend(sample_losses.tolist())
 
             if 'bleu' in metrics or 'accu' in metrics or 'bleurt' in metrics:
-                example_ids = model.generate(inputs, max_length=args.max_utter_len)
                 examples = tokenizer.batch_decode(example_ids, skip_special_tokens=True)
 
                 if 'bleu' in metrics or 'bleurt' in metrics:
-                    targets = tokenizer.batch_decode(labels, skip_special_tokens=True)
-                    for example, target in zip(examples, targets):
-                        if 'bleu' in metrics:
-                            bleu_scores.append(sacrebleu.sentence_bleu(example, [target]).score)
-                        if 'bleurt' in metrics:
-                            bleurt_scores.append(bleurt_scorer.score(references=[target], candidates=[example])[0])
+                    targets = tokenizer.batch_decode(labels.masked_fill(labels == IGNORE_INDEX, tokenizer.pad_token_id),
+                                                     skip_special_tokens=True)
+                    if 'bleu' in metrics:
+                        bleu.add(examples, targets)
+                    if 'bleurt' in metrics:
+                        bleurt_refs.extend(targets)
+                        bleurt_cands.extend(examples)
                 if 'accu' in metrics:
-                    sources = tokenizer.batch_decode(inputs, skip_special_tokens=True)
-                    for source, example in zip(sources, examples):
-                        slot_accuracies.append(calc_slot_accu(source, example))
+                    accu_indices.extend(indices.tolist())
+                    accu_cands.extend(examples)
+
+    if 'bleu' in metrics:
+        bleu_scores = bleu.sentence_scores().tolist()
+    if 'bleurt' in metrics:
+        bleurt_scores = calc_bleurt(bleurt_refs, bleurt_cands, args)
+    if 'accu' in metrics:
+        slot_accuracies = get_slot_accuracy(eval_dataloader.dataset).score(accu_cands, accu_indices)
 
     if sentence_level:
-        res = {'loss': eval_losses, "bleu": bleu_scores, "bleurt": bleurt_scores, 'accu': slot_accuracies}
+        # bucket batching evaluates in length order
+        order = get_sample_order(eval_dataloader)
+        res = {'loss': eval_losses, "bleu": bleu_scores, "bleu_stats": bleu.stats if bleu else [],
+               "bleurt": bleurt_scores, 'accu': slot_accuracies}
+        res = {k: restore_order(v, order) if v else v for k, v in res.items()}
     else:
         res = {}
         if "loss" in metrics:
             res['loss'] = sum(eval_losses) / len(eval_losses)
         if "bleu" in metrics:
             res['bleu'] = sum(bleu_scores) / len(bleu_scores)
+            res['corpus_bleu'] = bleu.corpus_score()
         if "bleurt" in metrics:
             res['bleurt'] = sum(bleurt_scores) / len(bleurt_scores)
         if "accu" in metrics:
@@ -187,6 +403,81 @@ def evaluate_data_set(eval_dataloader, model, tokenizer, metrics, args, sentence
     return res
 
 
+def checkpoint_hash(model_loc):
+    """ hash of the model and tokenizer files of a saved checkpoint (not logs or results written next to them) """
+    md5 = hashlib.md5()
+    for name in sorted(os.listdir(model_loc)):
+        path = os.path.join(model_loc, name)
+        if os.path.isfile(path) and any(fnmatch(name, pattern) for pattern in CHECKPOINT_FILES):
+            md5.update(name.encode('utf-8'))
+            md5.update(file_hash(path).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def get_baseline_metrics(args, model_loc, model_class, tokenizer_class, dataset, metrics):
+    """ Per-sample metrics of a trained baseline model on a dataset, cached in model_loc/sample_metrics.
+    Each metric is cached in its own file, keyed by the checkpoint and dataset contents (and the BLEURT checkpoint),
+    so runs that only change the curriculum hyper-params never re-run the baseline.
+    The baseline is loaded and evaluated only on a cache miss. Loss, BLEU and slot accuracy are always computed
+    together, since they share one generation pass.
+    metrics = ['loss', 'bleu', 'bleu_stats', 'bleurt', 'accu']
+    return: {metric: np.ndarray[len(dataset),]} in dataset order
+    """
+    cache_dir = os.path.join(model_loc, SAMPLE_METRICS_DIR)
+    model_key = checkpoint_hash(model_loc)
+
+    def cache_path(metric):
+        meta = {"model": model_key, "dataset": dataset.cache_key, "metric": metric}
+        if metric == "loss":
+            meta["loss"] = "masked"  # not the older losses averaged over the padded batch length
+        if metric == "bleurt":
+            meta["bleurt_checkpoint"] = os.path.abspath(args.bleurt_checkpoint) if args.bleurt_checkpoint else ""
+        key = hashlib.md5(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(cache_dir, f"{dataset.cache_key}.{metric}.{key}.npy")
+
+    def load(res, overwrite):
+        for metric in metrics:
+            if metric not in res and not overwrite and os.path.exists(cache_path(metric)):
+                res[metric] = np.load(cache_path(metric))
+        return [metric for metric in metrics if metric not in res]
+
+    res = {}
+    if not load(res, args.overwrite_cache):
+        logging.info("Loaded baseline sample metrics %s from %s", metrics, cache_dir)
+        return res
+
+    # one run evaluates the baseline, the others (e.g. the dcl cells released together by run_grid.py) wait for it
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(os.path.join(cache_dir, f"{dataset.cache_key}.lock")):
+        missing = load(res, args.overwrite_cache)  # filled in by a run that held the lock before us
+        if not missing:
+            logging.info("Loaded baseline sample metrics %s from %s", metrics, cache_dir)
+            return res
+        compute_baseline_metrics(args, model_loc, model_class, tokenizer_class, dataset, metrics, missing,
+                                 cache_path, res)
+    return res
+
+
+def compute_baseline_metrics(args, model_loc, model_class, tokenizer_class, dataset, metrics, missing, cache_path,
+                             res):
+    """ evaluate the baseline for the `missing` metrics (and those computed with them), cache them, add to res """
+    logging.info("Evaluating baseline %s on %d examples for %s", model_loc, len(dataset), missing)
+    model, tokenizer = load_checkpoint(model_loc, model_class, tokenizer_class)
+    dataloader, _ = get_data_loader_from_dataset(args, dataset, tokenizer, args.dev_batch_size, SequentialSampler)
+    eval_metrics = sorted((set(missing) | {"loss", "bleu", "accu"}) - {"bleu_stats"})
+    sample_metrics = evaluate_data_set(dataloader, model, tokenizer, eval_metrics, args, True)
+    computed = eval_metrics + ["bleu_stats"]
+    del model
+
+    for metric in computed:
+        values = np.asarray(sample_metrics[metric], dtype=np.float64)
+        tmp_path = f"{cache_path(metric)}.tmp.{os.getpid()}.npy"
+        np.save(tmp_path, values)
+        os.replace(tmp_path, cache_path(metric))  # never leave a partial cache behind
+        if metric in metrics:
+            res[metric] = values
+
+
 def save_result(result, path):
     os.makedirs(os.path.dirname(path), exist_ok=True)
     json.dump(result, open(path, 'w'), indent=2)
@@ -195,20 +486,42 @@ def save_result(result, path):
 ##############################
 # Main func called in exp.py #
 ##############################
+def score_sentences(pairs):
+    """ sentence BLEU and METEOR of a chunk of (output, target) pairs. Runs in a worker process. """
+    sentence_bleu, meteor_score = backend("sacrebleu").sentence_bleu, backend("meteor").meteor_score
+    return [(sentence_bleu(output, [target]).score, meteor_score([output], target)) for output, target in pairs]
+
+
+def calc_sentence_scores(outputs, targets, chunk_size, num_workers):
+    """ sentence BLEU and METEOR of each (output, target) pair, scored in chunks over a process pool.
+    num_workers: 0 for one worker per CPU, 1 to score in this process.
+    return: (bleu_scores, meteor_scores) in the input order
+    """
+    pairs = list(zip(outputs, targets))
+    chunks = [pairs[i: i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    num_workers = num_workers or os.cpu_count()
+    if num_workers == 1 or len(chunks) <= 1:
+        results = [score_sentences(chunk) for chunk in tqdm(chunks, desc="Evaluating")]
+    else:
+        with ProcessPoolExecutor(min(num_workers, len(chunks))) as executor:
+            # map yields the chunks in order
+            results = list(tqdm(executor.map(score_sentences, chunks), desc="Evaluating", total=len(chunks)))
+    scores = [score for chunk_scores in results for score in chunk_scores]
+    bleu_scores = [bleu for bleu, meteor in scores]
+    meteor_scores = [meteor for bleu, meteor in scores]
+    return bleu_scores, meteor_scores
+
+
 def evaluate_output(args, output_file, tgt_file, batch_size):
-    """ Compare predicted output and tgt output """
-    dataloader, len_dataset = get_comp_dataloader(output_file, tgt_file, batch_size)
-    bleu_scores, meteor_scores, bleurt_scores = [], [], []
-
-    bleurt_scorer = bleurt.score.BleurtScorer()
-    for batch in tqdm(dataloader, desc="Evaluating", total=len(dataloader)):
-        output, target = batch
-        output = output[0]
-        target = target[0]
-
-        bleu_scores.append(sacrebleu.sentence_bleu(output, [target]).score)
-        meteor_scores.append(meteor_score([output], target))
-        bleurt_scores.append(bleurt_scorer.score(references=[target], candidates=[output])[0])
+    """ Compare predicted output and tgt output
+    batch_size: number of (output, target) pairs per work unit of the evaluation workers
+    """
+    dataset = ComparisonDataset(output_file, tgt_file)
+    len_dataset = len(dataset)
+    outputs, targets = dataset.outputs, dataset.tgts
+
+    bleu_scores, meteor_scores = calc_sentence_scores(outputs, targets, batch_size, args.eval_num_workers)
+    bleurt_scores = calc_bleurt(targets, outputs, args)
 
     # Avg Evaluation
     avg_bleu = sum(bleu_scores) / len(bleu_scores)
@@ -1,56 +1,190 @@
+import os
 import torch
 import logging
 import json
 from tqdm import tqdm
+from torch.nn import CrossEntropyLoss
 from torch.utils.data import SequentialSampler
-from common.data import get_data_loader
+from common.data import get_data_loader, IGNORE_INDEX
+
+
+def get_attention_mask(model, inputs):
+    """ mask of the non-pad source tokens. Passed to every forward pass, so that a loss does not depend on the path """
+    return inputs.ne(model.config.pad_token_id).long()
+
+
+@torch.no_grad()
+def generate_with_loss(model, inputs, labels, max_length, with_loss=True):
+    """ Run the encoder once and reuse its outputs for both generation and the teacher-forced loss.
+    args:
+        inputs, labels (torch.LongTensor): padded source / target token ids
+        with_loss: if False, skip the teacher-forced decoder pass
+    return:
+        example_ids (torch.LongTensor): generated token ids
+        outputs (Seq2SeqLMOutput): teacher-forced outputs with .loss and .logits. None if not with_loss.
+    """
+    attention_mask = get_attention_mask(model, inputs)
+    encoder_outputs = model.get_encoder()(input_ids=inputs, attention_mask=attention_mask, return_dict=True)
+    example_ids = model.generate(inputs, attention_mask=attention_mask, encoder_outputs=encoder_outputs,
+                                 max_length=max_length)
+
+    outputs = None
+    if with_loss:
+        outputs = model(encoder_outputs=encoder_outputs, attention_mask=attention_mask, labels=labels)
+    return example_ids, outputs
+
+
+def calc_sample_losses(logits, labels):
+    """ token-averaged loss of each sample, over its own target tokens only: it does not depend on the batch.
+    args:
+        logits (torch.Tensor[batch, seq_len, vocab]), labels (torch.LongTensor[batch, seq_len]) padded with IGNORE_INDEX
+    return:
+        (torch.Tensor[batch,])
+    """
+    loss_fct = CrossEntropyLoss(ignore_index=IGNORE_INDEX, reduction='none')
+    token_losses = loss_fct(logits.permute(0, 2, 1), labels)
+    n_tokens = labels.ne(IGNORE_INDEX).sum(dim=1).clamp(min=1)
+    return token_losses.sum(dim=1) / n_tokens
+
+
+class DecodeWriter(object):
+    """
+    Streams the decoded lines to `path` (and, with_scores, one score per line to `path`.scores) in dataset order,
+    batch by batch, so a crash loses at most the batches in flight and memory does not grow with the dataset.
+    Lines decoded out of order (bucket batching) wait until all the lines before them are written: decode sorts by
+    length only within windows of --decode_sort_window batches, so at most about one window waits.
+    After every batch, the number of written lines, the file offsets and the loss sum of the written lines are
+    committed to `path`.progress.json. resume=True truncates the files to the committed offsets and continues there.
+    It starts over if the files do not hold the committed progress (missing, shorter, or written without scores).
+    """
+    def __init__(self, path, with_scores=False, resume=False):
+        self.path = path
+        self.scores_path = path + ".scores"
+        self.progress_path = path + ".progress.json"
+        self.progress = {"num_lines": 0, "offset": 0, "scores_offset": 0, "loss_sum": 0.0, "with_scores": with_scores}
+        if resume and os.path.exists(self.progress_path):
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+            if self.can_resume(progress, with_scores):
+                self.progress = progress
+            else:
+                logging.warning("Cannot resume from %s: the decoded files do not match it. Starting over.",
+                                self.progress_path)
+        resume = self.progress["num_lines"] > 0
+        self.fp = self.open(path, self.progress["offset"], resume)
+        self.scores_fp = self.open(self.scores_path, self.progress["scores_offset"], resume) if with_scores else None
+        self.pending_lines = {}  # example id: (line, score, loss) waiting for the lines before it
+
+    def can_resume(self, progress, with_scores):
+        def holds(path, offset):
+            return os.path.exists(path) and os.path.getsize(path) >= offset
+        return progress.get("with_scores", False) == with_scores and holds(self.path, progress["offset"]) \
+            and (not with_scores or holds(self.scores_path, progress["scores_offset"]))
+
+    @staticmethod
+    def open(path, offset, resume):
+        """ resume: truncate to offset (the file holds it), else start a new file """
+        fp = open(path, 'r+b' if resume else 'wb')
+        fp.truncate(offset)
+        fp.seek(offset)
+        return fp
+
+    @property
+    def num_lines(self):
+        return self.progress["num_lines"]
+
+    @property
+    def loss_sum(self):
+        return self.progress["loss_sum"]
+
+    def write(self, example_ids, lines, scores=None, losses=None):
+        """
+        example_ids: dataset index of each line. Lines before num_lines (written before a restart) are ignored.
+        losses: share of each line in the decoding loss, summed into self.loss_sum when the line is written
+        """
+        scores = [None] * len(lines) if scores is None else scores
+        losses = [0.0] * len(lines) if losses is None else losses
+        for idx, line, score, loss in zip(example_ids, lines, scores, losses):
+            if idx >= self.num_lines:
+                self.pending_lines[idx] = (line, score, loss)
+
+        while self.num_lines in self.pending_lines:
+            line, score, loss = self.pending_lines.pop(self.num_lines)
+            self.fp.write((line + "\n").encode('utf-8'))
+            if self.scores_fp:
+                self.scores_fp.write(f"{score:.6f}\n".encode('utf-8'))
+            self.progress["num_lines"] += 1
+            self.progress["loss_sum"] += loss
+        self.commit()
+
+    def commit(self):
+        self.fp.flush()
+        self.progress["offset"] = self.fp.tell()
+        if self.scores_fp:
+            self.scores_fp.flush()
+            self.progress["scores_offset"] = self.scores_fp.tell()
+        tmp_path = self.progress_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.progress, f)
+        os.replace(tmp_path, self.progress_path)
+
+    def close(self):
+        self.fp.close()
+        if self.scores_fp:
+            self.scores_fp.close()
 
 
 def decode(args, model, tokenizer):
     dataloader, len_dataset = get_data_loader(args, tokenizer, args.decode_input_file, args.decode_tgt_file,
-                                              args.decode_batch_size, SequentialSampler)
+                                              args.decode_batch_size, SequentialSampler, args.decode_sort_window)
+    output_path = args.decode_output_file or f"{args.output_dir}/results.txt"
+    writer = DecodeWriter(output_path, args.decode_scores, args.decode_resume)
 
     # Decode!
     logging.info("***** Decoding *****")
-    logging.info("  Num examples = %d", len_dataset)
+    logging.info("  Num examples = %d, Already decoded = %d", len_dataset, writer.num_lines)
     logging.info("  Batch size = %d", args.decode_batch_size)
+    logging.info("  Compute loss = %s", not args.decode_no_loss)
 
     model.to(args.device)
     model.eval()
 
-    eval_loss = 0.0
-    outputs = []  # predicted utterance
-
     for batch in tqdm(dataloader, desc="Decoding", total=len(dataloader)):
-        inputs, labels = batch
+        inputs, labels, example_ids = batch
+        example_ids = example_ids.tolist()
+        # resume: skip the batches written before the restart. Same batches as before, so the same losses
+        if max(example_ids) < writer.num_lines:
+            continue
         inputs = inputs.to(args.device)
         labels = labels.to(args.device)
 
-        example_ids = model.generate(inputs, max_length=args.max_utter_len)
-        examples = tokenizer.batch_decode(example_ids, skip_special_tokens=True)
-        outputs.extend(examples)
+        output_ids, model_outputs = generate_with_loss(model, inputs, labels, args.max_utter_len,
+                                                       with_loss=not args.decode_no_loss)
+        examples = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
 
         # Evaluate
-        with torch.no_grad():
-            loss = model(inputs, labels=labels).loss
-            eval_loss += loss.item() * len(labels)
-
-    # Avg Evaluation
-    avg_loss = eval_loss / len_dataset
-    perplexity = torch.exp(torch.tensor(avg_loss)).item()
-
-    results = {
-        'avg loss': avg_loss,
-        'perplexity': perplexity,
-    }
-
-    # save
-    path1 = f"{args.output_dir}/decode_loss.json"
-    json.dump(results, open(path1, 'w'), indent=2)
-    logging.info("Decoding loss saved to {}".format(path1))
-
-    path2 = f"{args.output_dir}/results.txt"
-    with open(path2, 'w', encoding='utf-8') as fp:
-        fp.write("\n".join(outputs))
-    logging.info("Decoded file saved to {}".format(path2))
-    return outputs, results
+        losses = None
+        if model_outputs is not None:
+            losses = calc_sample_losses(model_outputs.logits.float(), labels).tolist()
+        # bucket batching decodes in length order: the writer restores the dataset order
+        writer.write(example_ids, examples, losses if args.decode_scores else None, losses)
+    writer.close()
+
+    results = {}
+    if not args.decode_no_loss:
+        # Avg Evaluation
+        avg_loss = writer.loss_sum / len_dataset
+        perplexity = torch.exp(torch.tensor(avg_loss)).item()
+
+        results = {
+            'avg loss': avg_loss,
+            'perplexity': perplexity,
+        }
+
+        # save
+        path1 = f"{args.output_dir}/decode_loss.json"
+        json.dump(results, open(path1, 'w'), indent=2)
+        logging.info("Decoding loss saved to {}".format(path1))
+
+    logging.info("Decoded file saved to {}".format(output_path))
+    return results
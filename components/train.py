@@ -1,33 +1,42 @@
 import logging
+import contextlib
 import torch
-import json
 import numpy as np
 from tqdm import trange
 from transformers import Adafactor
-from torch.nn import CrossEntropyLoss
 from torch.utils.data import SequentialSampler, RandomSampler
 from torch.utils.data.dataloader import DataLoader
 
-from common.utils import set_seed, save_checkpoint, load_checkpoint
-from common.data import get_dataset, get_data_loader, get_data_loader_from_dataset, get_collate_fn
-from common.curriculum import BucketCurriculum, DynamicCurriculum, intent_slot_score_fn, SplRegularizer
-from components.evaluate import evaluate_data_set
+from common.utils import set_seed, save_checkpoint, CheckpointWriter, HistoryLog, TrainingState
+from common.data import get_dataset, get_data_loader, get_data_loader_from_dataset, get_collate_fn, \
+    TokenBudgetBatchSampler
+from common.curriculum import BucketCurriculum, DynamicCurriculum, SplRegularizer, \
+    SampleLossTracker, PhaseLossBuffer
+from components.generate import get_attention_mask, calc_sample_losses
+from components.evaluate import evaluate_data_set, get_baseline_metrics, BleuAccumulator
 
 
-def update_history(args, new_hist):
-    with open(f"{args.output_dir}/history.json", 'r') as f:
-        history = json.load(f)
-    for k, v in new_hist.items():
-        history[k].extend(v)
-    with open(f"{args.output_dir}/history.json", 'w') as f:
-        json.dump(history, f, indent=4)
+def autocast(args):
+    """ bf16 mixed precision for the forward pass if args.bf16 """
+    if args.bf16:
+        return torch.autocast(device_type=args.device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
 
 
 def train_with_dataloader(args, train_dataloader, model, tokenizer, eval_dataloader, len_eval_dataset,
-                          spl_regularizer=None):
+                          spl_regularizer=None, checkpoint_writer=None, history_log=None, loss_tracker=None,
+                          training_state=None, curriculum=0):
+    """
+    history_log (HistoryLog): if given, batch and epoch records are appended to it as one curriculum
+    loss_tracker (SampleLossTracker): if given, records the loss of every training sample seen
+    training_state (TrainingState): if given, saved after every epoch, or restored if it resumes at this curriculum
+    curriculum (Int): index of this curriculum / phase
+    """
     # steps
     # t_total = len(train_dataloader) * args.num_train_epochs
 
+    save = checkpoint_writer.save if checkpoint_writer else save_checkpoint
+
     # optimizer
     optimizer = Adafactor(model.parameters(), lr=args.learning_rate,
                           eps=(1e-30, 1e-3),
@@ -40,54 +49,75 @@ def train_with_dataloader(args, train_dataloader, model, tokenizer, eval_dataloa
                           warmup_init=False)
 
     global_step, logging_loss, patience, best_epoch_loss = 0, 0, 0, float('inf')
-    batch_losses, batch_ex_seen, epoch_losses, epoch_ex_seen = [], [], [], []
-    neg_bleu, slot_accu = [], []
-    model.train()
-
-    if spl_regularizer:  # to get loss for each individual sample
-        loss_fct = CrossEntropyLoss(ignore_index=-100, reduction='none')
-
-    for e in trange(int(args.num_train_epochs), desc="Epoch"):
-        running_loss, running_ex = 0.0, 0  # accumulated loss of each epoch
+    best_neg_bleu = float('inf')
+    start_epoch, stop, train_mode = 0, False, True
+    if history_log:
+        history_log.next_curriculum()
+    if training_state and training_state.resumes_at(curriculum):
+        loop = training_state.restore(model, optimizer)
+        start_epoch, stop = loop["next_epoch"], loop["stop"]
+        global_step, patience = loop["global_step"], loop["patience"]
+        best_epoch_loss, best_neg_bleu = loop["best_epoch_loss"], loop["best_neg_bleu"]
+        train_mode = loop["train_mode"]  # evaluate_data_set leaves the model in eval mode
+        # the token budget sampler samples its next epoch early: with the RNG states from before the restore
+        if isinstance(train_dataloader.batch_sampler, TokenBudgetBatchSampler):
+            train_dataloader.batch_sampler.next_batches = None
+    model.zero_grad()
+    model.train(train_mode)
+
+    for e in trange(start_epoch, int(args.num_train_epochs) if not stop else start_epoch, desc="Epoch"):
+        n_steps = len(train_dataloader)
+        # kept on device to avoid a host sync per step. transferred once at the end of the epoch
+        step_losses = torch.zeros(n_steps, device=args.device)
+        step_ex = []
+        running_loss = torch.zeros((), device=args.device)  # accumulated loss of each epoch
 
         # sample weights for each batch
         if spl_regularizer:
-            prev_v_s = [1] * len(train_dataloader)  # v from prev epoch
+            prev_v_s = [1] * n_steps  # v from prev epoch
             v_s = []
 
         for step, batch in enumerate(train_dataloader):
             # logging.info(f"  PROGRESS: {float(global_step) / t_total * 100:.2f}%")
 
-            inputs, labels = batch
+            inputs, labels, example_ids = batch
             inputs = inputs.to(args.device)
             labels = labels.to(args.device)
 
-            model.zero_grad()
-            outputs = model(inputs, labels=labels)
+            with autocast(args):
+                outputs = model(inputs, attention_mask=get_attention_mask(model, inputs), labels=labels)
 
-            if spl_regularizer:
-                tmp_loss = loss_fct(outputs.logits.permute(1, 2, 0), labels.permute(1, 0))
-                sample_loss = torch.mean(tmp_loss, dim=0)  # token avg loss for each sample
+            # losses in fp32, also under bf16 autocast
+            if spl_regularizer or loss_tracker:
+                sample_loss = calc_sample_losses(outputs.logits.float(), labels)  # token avg loss for each sample
                 # assert(torch.mean(sample_loss) == outputs.loss)  # TODO: minor mean vs major mean?
+            if loss_tracker:
+                loss_tracker.update(example_ids, sample_loss.detach())
 
+            if spl_regularizer:
                 loss = torch.mean(prev_v_s[step] * sample_loss)
                 v = spl_regularizer.v(sample_loss)  # new sample weight
                 v_s.append(v)
             else:
-                loss = outputs.loss
-            loss.backward()
+                loss = outputs.loss.float()
 
-            running_loss += loss.item() * len(labels)
-            running_ex += len(labels)
-            batch_losses.append(loss.item())
-            batch_ex_seen.append(len(labels))
+            # average the gradients over the micro-batches of one optimizer step (the last group may be smaller)
+            group_start = step - step % args.gradient_accumulation_steps
+            group_size = min(args.gradient_accumulation_steps, n_steps - group_start)
+            (loss / group_size).backward()
+
+            running_loss += loss.detach() * len(labels)
+            step_losses[step] = loss.detach()
+            step_ex.append(len(labels))
 
             # # clip gradient
             # if args.max_grad_norm > 0.:
             #     grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
-            optimizer.step()
-            global_step += 1
+            if step + 1 - group_start == group_size:
+                optimizer.step()
+                model.zero_grad()
+                global_step += 1
 
             # # logging
             # if args.logging_steps > 0 and global_step % args.logging_steps == 0:
@@ -107,9 +137,19 @@ def train_with_dataloader(args, train_dataloader, model, tokenizer, eval_dataloa
             spl_regularizer.update_hyper()
             prev_v_s = v_s
 
-        epoch_loss = running_loss / running_ex
-        epoch_losses.append(epoch_loss)
-        epoch_ex_seen.append(running_ex)
+        # batch history, averaged over every args.log_every_n_steps steps of the epoch
+        step_losses = step_losses[:len(step_ex)].tolist()
+        for start in range(0, len(step_ex), args.log_every_n_steps):
+            interval_ex = step_ex[start: start + args.log_every_n_steps]
+            interval_losses = step_losses[start: start + args.log_every_n_steps]
+            interval_loss = sum(l * n for l, n in zip(interval_losses, interval_ex)) / sum(interval_ex) \
+                if len(interval_ex) > 1 else interval_losses[0]
+            if history_log:
+                history_log.log("batch", batch_losses=interval_loss, batch_ex_seen=sum(interval_ex))
+
+        running_ex = sum(step_ex)
+        epoch_loss = running_loss.item() / running_ex
+        epoch_record = {"epoch_losses": epoch_loss, "epoch_ex_seen": running_ex}
         best_epoch_loss = min(best_epoch_loss, epoch_loss)
         logging.info("[Epoch %d] Running loss = %.4f", e + 1, epoch_loss)
 
@@ -117,36 +157,41 @@ def train_with_dataloader(args, train_dataloader, model, tokenizer, eval_dataloa
         if args.eval_while_train:
             metrics = evaluate_data_set(eval_dataloader, model, tokenizer, ["bleu", "accu"], args, False)
             dev_loss, accu = - metrics['bleu'], metrics['accu']
-            is_better = neg_bleu == [] or dev_loss < min(neg_bleu)
-            neg_bleu.append(dev_loss)
-            slot_accu.append(accu)
+            is_better = dev_loss < best_neg_bleu
+            best_neg_bleu = min(best_neg_bleu, dev_loss)
+            epoch_record.update(neg_bleu=dev_loss, corpus_bleu=metrics['corpus_bleu'], slot_accu=accu)
             logging.info("[Epoch %d] Running loss = %.4f  Dev loss = %.4f", e + 1, epoch_loss, dev_loss)
 
+        if history_log:
+            history_log.log("epoch", **epoch_record)
+            history_log.flush()
+
+        if args.eval_while_train:
             if e <= 50 or is_better:
                 patience = 0
-                save_checkpoint(args.output_dir, model, tokenizer, args)
+                save(args.output_dir, model, tokenizer, args)
             else:
                 patience += 1
 
-            if 0 < args.train_patience <= patience:
-                print('early stop')
-                logging.info(f"Max patience {args.train_patience} hit. Early stopping at epoch {e}.")
-                break
+            stop = 0 < args.train_patience <= patience
         else:
-            save_checkpoint(args.output_dir, model, tokenizer, args)
+            save(args.output_dir, model, tokenizer, args)
 
-    result = {
-        "batch_losses": batch_losses,
-        "batch_ex_seen": batch_ex_seen,
-        "epoch_losses": epoch_losses,
-        "epoch_ex_seen": epoch_ex_seen,
-        "neg_bleu": neg_bleu,
-        "slot_accu": slot_accu
-    }
-    return model, best_epoch_loss, result
+        if training_state:
+            training_state.save(curriculum, model, optimizer,
+                                {"next_epoch": e + 1, "stop": stop, "global_step": global_step, "patience": patience,
+                                 "best_epoch_loss": best_epoch_loss, "best_neg_bleu": best_neg_bleu,
+                                 "train_mode": model.training})
+        if stop:
+            print('early stop')
+            logging.info(f"Max patience {args.train_patience} hit. Early stopping at epoch {e}.")
+            break
 
+    return model, best_epoch_loss
 
-def train_with_one_bucket(args, model, tokenizer, eval_dataloader, len_eval_dataset, spl_regularizer=None):
+
+def train_with_one_bucket(args, model, tokenizer, eval_dataloader, len_eval_dataset, spl_regularizer=None,
+                          checkpoint_writer=None, history_log=None, training_state=None):
     """ View entire training data as one curriculum """
     # train dataloader
     train_dataloader, len_train_dataset = get_data_loader(args, tokenizer, args.train_data_file, args.train_tgt_file,
@@ -160,109 +205,137 @@ def train_with_one_bucket(args, model, tokenizer, eval_dataloader, len_eval_data
     logging.info("  Num examples = %d", len_train_dataset)
     logging.info("  Num Epochs = %d", args.num_train_epochs)
     logging.info("  Training batch size = %d", args.train_batch_size)
+    logging.info("  Max tokens per batch = %d", args.max_tokens_per_batch)
 
     # train
-    model, best_epoch_loss, result = train_with_dataloader(args, train_dataloader, model, tokenizer,
-                                          eval_dataloader, len_eval_dataset, spl_regularizer)
+    model, best_epoch_loss = train_with_dataloader(args, train_dataloader, model, tokenizer, eval_dataloader,
+                                                   len_eval_dataset, spl_regularizer, checkpoint_writer, history_log,
+                                                   training_state=training_state)
     logging.info("  Loss = %.4f", best_epoch_loss)
-
-    # save history
-    history = {}
-    for k, v in result.items():
-        history[k] = [v]
-    with open(f"{args.output_dir}/history.json", 'w') as f:
-        json.dump(history, f, indent=4)
-
     return model
 
 
-def train_bucket_curriculum(args, model, tokenizer, eval_dataloader, len_eval_dataset, score_fn):
+def train_bucket_curriculum(args, model, tokenizer, eval_dataloader, len_eval_dataset, scorer,
+                            checkpoint_writer=None, history_log=None, training_state=None):
     # data
-    dataset = get_dataset(args.train_data_file, args.train_tgt_file, args.data_cache_dir, args.overwrite_cache)
+    dataset = get_dataset(args, tokenizer, args.train_data_file, args.train_tgt_file)
 
     # bucket curriculum
-    curriculums = BucketCurriculum(dataset, score_fn)\
+    scorer_kwargs = {}
+    if scorer.startswith("baseline_"):
+        scorer_kwargs["baseline_metrics"] = get_baseline_metrics(args, args.dcl_baseline, type(model), type(tokenizer),
+                                                                 dataset, ["loss", "bleu", "accu"])
+    curriculums = BucketCurriculum(dataset, scorer, **scorer_kwargs)\
         .get_curriculum(num_bucket=args.curriculum_num_bucket, batch_size=args.train_batch_size,
-                        name=args.curriculum_name, collate_fn=get_collate_fn(args, tokenizer))
+                        name=args.curriculum_name, collate_fn=get_collate_fn(args, tokenizer),
+                        bucket_batching=args.bucket_batching, max_tokens=args.max_tokens_per_batch)
 
     # Train!
     logging.info("***** Running bucket curriculum training *****")
     logging.info("  Training batch size = %d", args.train_batch_size)
     logging.info("  Max Epochs Per Curriculum = %d", args.num_train_epochs)
 
-    history = {}
     best_epoch_loss = float('inf')
     for idx, curriculum in enumerate(curriculums):
+        if training_state and training_state.skip(idx):
+            continue
         curriculum_dataloader, len_curriculum_dataset = curriculum
         logging.info("  ***** Curriculum = %d *****", idx+1)
         logging.info("  Num examples = %d", len_curriculum_dataset)
 
-        model, best_curr_loss, result = train_with_dataloader(args, curriculum_dataloader, model, tokenizer,
-                                                              eval_dataloader, len_eval_dataset)
+        model, best_curr_loss = train_with_dataloader(args, curriculum_dataloader, model, tokenizer,
+                                                      eval_dataloader, len_eval_dataset,
+                                                      checkpoint_writer=checkpoint_writer, history_log=history_log,
+                                                      training_state=training_state, curriculum=idx)
         best_epoch_loss = min(best_epoch_loss, best_curr_loss)
         logging.info("  Loss = %.4f", best_epoch_loss)
+    return model
 
-        # save history
-        for k, v in result.items():
-            if k in history:
-                history[k].append(v)
-            else:
-                history[k] = [v]
 
-    with open(f"{args.output_dir}/history.json", 'w') as f:
-        json.dump(history, f, indent=4)
-    return model
+def train_dcl_phase(args, model, tokenizer, eval_dataloader, len_eval_dataset, dcl, checkpoint_writer, history_log,
+                    loss_tracker, training_state, t):
+    """ train DCL phase t on the easiest samples given dcl.difficulties and the phase competence dcl.competences[-1] """
+    # Sort samples by difficulties
+    # Use the easier subset
+    curriculum_dataloader = dcl.get_curriculum(dcl.difficulties, dcl.competences[-1], args.train_batch_size,
+                                               get_collate_fn(args, tokenizer), args.bucket_batching,
+                                               args.max_tokens_per_batch)
+    return train_with_dataloader(args, curriculum_dataloader, model, tokenizer, eval_dataloader, len_eval_dataset,
+                                 checkpoint_writer=checkpoint_writer, history_log=history_log,
+                                 loss_tracker=loss_tracker, training_state=training_state, curriculum=t)
 
 
-def train_with_dynamic_curriculum(args, model, tokenizer, eval_dataloader, len_eval_dataset, bleurt=False):
+def train_with_dynamic_curriculum(args, model, tokenizer, eval_dataloader, len_eval_dataset, bleurt=False,
+                                  checkpoint_writer=None, history_log=None, training_state=None):
     """
     model, tokenizer: load from t5-small
     baseline_model, baseline_tokenizer: trained baseline model to init BLEU_T
     """
     # train_dataset
-    train_dataset = get_dataset(args.train_data_file, args.train_tgt_file, args.data_cache_dir, args.overwrite_cache)
-
-    # baseline vanilla model without CL
-    model_class, tokenizer_class = type(model), type(tokenizer)
-    baseline_model, baseline_tokenizer = load_checkpoint(args.dcl_baseline, model_class, tokenizer_class)
+    train_dataset = get_dataset(args, tokenizer, args.train_data_file, args.train_tgt_file)
 
-    # baseline model BLEU_T
-    seq_train_dataloader, len_train_dataset = get_data_loader_from_dataset(args, train_dataset, baseline_tokenizer,
-                                                                           args.dev_batch_size, SequentialSampler)
+    len_train_dataset = len(train_dataset)
 
-    if bleurt:
-        metrics = evaluate_data_set(seq_train_dataloader, baseline_model, baseline_tokenizer, ["bleurt", "accu"], args)
-        bleu_T, accu_T = metrics["bleurt"], metrics["accu"]
+    # baseline vanilla model without CL: BLEU_T, from its cached per-sample metrics
+    bleu_metric = "bleurt" if bleurt else "bleu_stats" if args.dcl_corpus_bleu else "bleu"
+    metrics = get_baseline_metrics(args, args.dcl_baseline, type(model), type(tokenizer), train_dataset,
+                                   [bleu_metric, "accu"])
+    if bleu_metric == "bleu_stats":
+        bleu_T = BleuAccumulator.corpus_bleu(metrics["bleu_stats"])
     else:
-        metrics = evaluate_data_set(seq_train_dataloader, baseline_model, baseline_tokenizer, ["bleu", "accu"], args)
-        bleu_T, accu_T = metrics["bleu"], metrics["accu"]
+        bleu_T = metrics[bleu_metric].mean()
+    accu_T = metrics["accu"].mean()
 
     # train by phases
-    history = {}
     best_epoch_loss = float('inf')
 
-    dcl = DynamicCurriculum(train_dataset)
-    phase_losses = np.empty((0, len_train_dataset))  # historical losses for past 'a' phases
+    dcl = DynamicCurriculum(train_dataset, args.dcl_c0)
+    loss_tracker = SampleLossTracker(len_train_dataset, args.device)
+    # historical losses for past 'a' phases
+    mmap_path = f"{args.output_dir}/dcl_phase_losses.npy" if len_train_dataset >= args.dcl_mmap_min_samples else None
+    phase_losses = PhaseLossBuffer(len_train_dataset, args.dcl_a, mmap_path)
+    difficulties = dcl.difficulties
     # phase_accu = np.empty((0, len_train_dataset))  # historical slot accuracies for past 'a' phases
-    c_s = [args.dcl_c0]  # model competences
+    c_s = dcl.competences  # model competences
+    if training_state:
+        training_state.register("dcl", dcl)
+        training_state.register("loss_tracker", loss_tracker)
+        training_state.register("phase_losses", phase_losses)
 
     for t in trange(int(args.dcl_phase), desc="Phase"):
+        if training_state and training_state.skip(t):
+            continue
         logging.info(f"Dynamic CL - [Phase {t+1}]")
-
-        # get training sample losses
-        seq_train_dataloader, len_train_dataset = get_data_loader_from_dataset(args, train_dataset, tokenizer,
-                                                                               args.dev_batch_size, SequentialSampler)
-        metrics = evaluate_data_set(seq_train_dataloader, model, tokenizer, ["loss"], args, True)
-        phase_losses = np.append(phase_losses, [metrics["loss"]], axis=0)
+        if training_state and training_state.resumes_at(t):
+            # the phase was started before the interruption: its difficulties and competence are in the state
+            training_state.load_components()
+            model, best_curr_loss = train_dcl_phase(args, model, tokenizer, eval_dataloader, len_eval_dataset, dcl,
+                                                    checkpoint_writer, history_log, loss_tracker, training_state, t)
+            best_epoch_loss = min(best_epoch_loss, best_curr_loss)
+            continue
+
+        # get training sample losses: full loss pass in the first phase, afterwards the losses recorded during
+        # training plus a refresh of a sample of the stale ones (not trained on in the last phase)
+        if t == 0 or args.dcl_full_loss_pass:
+            refresh_indices = np.arange(len_train_dataset)
+        else:
+            stale_indices = loss_tracker.stale_indices()
+            n_refresh = int(round(len(stale_indices) * args.dcl_refresh_ratio))
+            refresh_indices = np.sort(np.random.choice(stale_indices, n_refresh, replace=False))
+            logging.info(f"  Recorded losses = {len_train_dataset - len(stale_indices)}, "
+                         f"Stale losses = {len(stale_indices)}, Refreshed = {n_refresh}")
+        if len(refresh_indices) > 0:
+            refresh_dataloader, _ = get_data_loader_from_dataset(args, train_dataset, tokenizer,
+                                                                 args.dev_batch_size, SequentialSampler,
+                                                                 indices=refresh_indices)
+            metrics = evaluate_data_set(refresh_dataloader, model, tokenizer, ["loss"], args, True)
+            loss_tracker.update(refresh_indices, metrics["loss"])
+        phase_losses.append(loss_tracker.snapshot())
+        loss_tracker.start_phase()
         # phase_accu = np.append(phase_accu, [metrics["accu"]], axis=0)
 
         # get sample difficulties
-        if t < args.dcl_a:
-            difficulties = phase_losses[-1]
-        else:
-            difficulties = (phase_losses[-1] - phase_losses[0]) / phase_losses[0]
-            phase_losses = np.delete(phase_losses, 0, axis=0)
-            # phase_accu = np.delete(phase_accu, 0, axis=0)
+        phase_losses.difficulties(out=difficulties)
 
         # dev set BLEU_t
         if bleurt:
@@ -270,7 +343,8 @@ def train_with_dynamic_curriculum(args, model, tokenizer, eval_dataloader, len_e
             bleu_t, accu_t = metrics["bleurt"], metrics["accu"]
         else:
             metrics = evaluate_data_set(eval_dataloader, model, tokenizer, ["bleu", "accu"], args)
-            bleu_t, accu_t = metrics["bleu"], metrics["accu"]
+            bleu_t = metrics["corpus_bleu"] if args.dcl_corpus_bleu else metrics["bleu"]
+            accu_t = metrics["accu"]
 
         # estimate model competence
         if args.curriculum_name == "dcl.accu":
@@ -282,29 +356,14 @@ def train_with_dynamic_curriculum(args, model, tokenizer, eval_dataloader, len_e
             c_t = min(1, (bleu_t / bleu_T) * (1 - c_s[0]) / beta + c_s[0])
         c_s.append(c_t)
 
-        # Sort samples by difficulties
-        # Use the easier subset
-        curriculum_dataloader = dcl.get_curriculum(difficulties, c_t, args.train_batch_size,
-                                                   get_collate_fn(args, tokenizer))
-
         # train
-        model, best_curr_loss, result = train_with_dataloader(args, curriculum_dataloader, model, tokenizer,
-                                                              eval_dataloader, len_eval_dataset)
+        model, best_curr_loss = train_dcl_phase(args, model, tokenizer, eval_dataloader, len_eval_dataset, dcl,
+                                                checkpoint_writer, history_log, loss_tracker, training_state, t)
 
         # record training results
         best_epoch_loss = min(best_epoch_loss, best_curr_loss)
         logging.info("  Best Epoch Loss = %.4f", best_epoch_loss)
 
-        # save to history
-        for k, v in result.items():
-            if k in history:
-                history[k].append(v)
-            else:
-                history[k] = [v]
-
-    with open(f"{args.output_dir}/history.json", 'w') as f:
-        json.dump(history, f, indent=4)
-
     return model
 
 
@@ -328,13 +387,28 @@ def train(args, model, tokenizer):
         spl_regularizer = None
 
     # Train!
-    if args.curriculum_name == "NC" or "spl" in args.curriculum_name:
-        model = train_with_one_bucket(args, model, tokenizer, eval_dataloader, len_eval_dataset, spl_regularizer)
-    elif args.curriculum_name in ["one_pass", "baby_step"]:
-        model = train_bucket_curriculum(args, model, tokenizer, eval_dataloader, len_eval_dataset, intent_slot_score_fn)
-    elif "dcl" in args.curriculum_name:
-        model = train_with_dynamic_curriculum(args, model, tokenizer, eval_dataloader, len_eval_dataset)
-    else:
-        raise ValueError("Invalid args.curriculum_name.")
+    checkpoint_writer = CheckpointWriter(args)
+    history_log = HistoryLog(f"{args.output_dir}/history.jsonl", append=bool(args.resume_from))
+    training_state = TrainingState(args)
+    training_state.register("checkpoint_writer", checkpoint_writer)
+    training_state.register("history_log", history_log)
+    if spl_regularizer:
+        training_state.register("spl_regularizer", spl_regularizer)
+    try:
+        if args.curriculum_name == "NC" or "spl" in args.curriculum_name:
+            model = train_with_one_bucket(args, model, tokenizer, eval_dataloader, len_eval_dataset, spl_regularizer,
+                                          checkpoint_writer, history_log, training_state)
+        elif args.curriculum_name in ["one_pass", "baby_step"]:
+            model = train_bucket_curriculum(args, model, tokenizer, eval_dataloader, len_eval_dataset,
+                                            args.curriculum_scorer, checkpoint_writer, history_log, training_state)
+        elif "dcl" in args.curriculum_name:
+            model = train_with_dynamic_curriculum(args, model, tokenizer, eval_dataloader, len_eval_dataset,
+                                                  checkpoint_writer=checkpoint_writer, history_log=history_log,
+                                                  training_state=training_state)
+        else:
+            raise ValueError("Invalid args.curriculum_name.")
+    finally:
+        checkpoint_writer.close()  # flush pending saves
+        history_log.close()
 
     return model
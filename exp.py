@@ -2,7 +2,7 @@ from transformers import T5Config, T5ForConditionalGeneration, T5Tokenizer
 from common.utils import init_arg_parser, check_config, load_checkpoint
 from components.train import train
 from components.generate import decode
-from components.evaluate import evaluate_output
+from components.evaluate import evaluate_output, BLEURT_SCORERS
 
 MODEL_CLASSES = {
     # 'gpt2': (GPT2Config, GPT2LMHeadModel, GPT2Tokenizer),
@@ -37,3 +37,5 @@ if __name__ == '__main__':
         evaluate_output(args, args.eval_output_file, args.eval_tgt_file, args.eval_batch_size)
     else:
         raise ValueError("Invalid running mode for exp.py")
+
+    BLEURT_SCORERS.close()
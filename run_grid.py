@@ -0,0 +1,206 @@
+"""Run a grid of training experiments, (dataset, domain, curriculum, seed), over a pool of worker processes.
+The base model is loaded once, into shared memory, and passed to the workers: they all map the same weights instead
+of each deserializing a private copy, and train each of their cells from a private copy of them.
+Finished cells are marked with GRID_DONE_FILE in their output dir and skipped when the grid is re-run.
+DCL cells wait for the NC cell of the same (dataset, domain, seed), which is their baseline.
+
+usage:
+    python run_grid.py --dataset fewshotwoz --domains attraction hotel --curricula NC one_pass dcl --seeds 42 43 \
+        -- --num_train_epochs 100 --eval_while_train
+Arguments after '--' are passed to every exp.py run.
+"""
+import os
+import copy
+import json
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+GRID_DONE_FILE = "grid_done.json"
+WORKER = {}  # per worker process: shared base model and tokenizer
+
+
+###########
+#  cells  #
+###########
+def cell_output_dir(args, cell):
+    dataset, domain, curriculum, seed = cell
+    return os.path.join(args.output_root, args.cell_dir.format(dataset=dataset, domain=domain, curriculum=curriculum,
+                                                               seed=seed))
+
+
+def cell_baseline(cell):
+    """ the NC cell that a DCL cell uses as its baseline, or None """
+    dataset, domain, curriculum, seed = cell
+    return (dataset, domain, "NC", seed) if "dcl" in curriculum else None
+
+
+def cell_argv(args, cell):
+    dataset, domain, curriculum, seed = cell
+    data_folder = os.path.join(args.data_root, dataset, domain)
+    argv = [
+        "--mode", "train",
+        "--seed", str(seed),
+        "--model_type", args.model_type,
+        "--model_name", args.model_name,
+        "--curriculum_name", curriculum,
+        "--output_dir", cell_output_dir(args, cell),
+        "--train_data_file", os.path.join(data_folder, args.train_file + ".src"),
+        "--train_tgt_file", os.path.join(data_folder, args.train_file + ".trg"),
+        "--dev_data_file", os.path.join(data_folder, args.dev_file + ".src"),
+        "--dev_tgt_file", os.path.join(data_folder, args.dev_file + ".trg"),
+        "--data_cache_dir", os.path.join(args.cache_root, dataset, domain),
+        "--overwrite_output_dir",  # an unfinished cell is re-run from scratch
+    ]
+    if cell_baseline(cell) and "--dcl_baseline" not in args.exp_args:
+        argv += ["--dcl_baseline", cell_output_dir(args, cell_baseline(cell))]
+    return argv + args.exp_args
+
+
+def is_done(args, cell):
+    return os.path.exists(os.path.join(cell_output_dir(args, cell), GRID_DONE_FILE))
+
+
+############
+#  worker  #
+############
+def init_worker(model, tokenizer, num_threads):
+    """ model: base model with its weights in shared memory """
+    import torch
+
+    torch.set_num_threads(num_threads)
+    WORKER["model"], WORKER["tokenizer"] = model, tokenizer
+
+
+def run_cell(argv):
+    """ train one cell in this worker. return: (seconds, traceback or None, process_memory() while training) """
+    from common.utils import init_arg_parser, check_config, process_memory
+    from components.train import train
+
+    start = time.time()
+    memory = {}
+    try:
+        # check_config logs to the cell's output dir
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+            handler.close()
+        args = check_config(init_arg_parser(), argv)
+        model = copy.deepcopy(WORKER["model"])  # private copy of the shared base weights
+        memory = process_memory()
+        train(args, model, WORKER["tokenizer"])
+        with open(os.path.join(args.output_dir, GRID_DONE_FILE), 'w') as f:
+            json.dump({"argv": argv, "seconds": time.time() - start}, f, indent=2)
+        return time.time() - start, None, memory
+    except Exception:
+        return time.time() - start, traceback.format_exc(), memory
+
+
+def available_memory():
+    """ available host memory in bytes, or None if unknown """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def num_workers(args):
+    """ as many workers as both the cores and the memory allow """
+    if args.num_workers > 0:
+        return args.num_workers
+    by_cores = max(1, (os.cpu_count() or 1) // args.threads_per_worker)
+    memory = available_memory()
+    by_memory = by_cores if memory is None else max(1, int(memory // (args.worker_memory_gb * 2 ** 30)))
+    return min(by_cores, by_memory)
+
+
+##########
+#  main  #
+##########
+def run_grid(args):
+    cells = [(dataset, domain, curriculum, seed) for dataset in args.datasets for domain in args.domains
+             for curriculum in args.curricula for seed in args.seeds]
+    todo = [cell for cell in cells if not is_done(args, cell)]
+    logging.info("Grid cells = %d, Done = %d, To run = %d", len(cells), len(cells) - len(todo), len(todo))
+    if not todo:
+        return []
+
+    # cells whose baseline must run first
+    waiting = {cell: cell_baseline(cell) for cell in todo
+               if cell_baseline(cell) in todo and "--dcl_baseline" not in args.exp_args}
+    failed = []
+    n_workers = min(num_workers(args), len(todo))
+    logging.info("Workers = %d, Threads per worker = %d", n_workers, args.threads_per_worker)
+
+    from exp import MODEL_CLASSES
+    from common.utils import load_shared_checkpoint, model_size
+    config_class, model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+    model, tokenizer = load_shared_checkpoint(args.model_name, model_class, tokenizer_class)
+    weights_mb = model_size(model) / 2 ** 20
+    logging.info("Base model weights = %.0f MB, one copy in shared memory instead of one per worker. "
+                 "Saves %.0f MB over %d workers", weights_mb, weights_mb * (n_workers - 1), n_workers)
+
+    # spawn: workers must not inherit a CUDA context
+    with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker,
+                             initargs=(model, tokenizer, args.threads_per_worker)) as executor:
+        running = {executor.submit(run_cell, cell_argv(args, cell)): cell for cell in todo if cell not in waiting}
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                cell = running.pop(future)
+                seconds, error, memory = future.result()
+                if memory:
+                    logging.info("Worker memory of %s: private %.0f MB, shared %.0f MB", cell,
+                                 memory["anon"] / 2 ** 20, memory["shmem"] / 2 ** 20)
+                if error is None:
+                    logging.info("Done %s in %.0fs", cell, seconds)
+                else:
+                    logging.error("Failed %s after %.0fs:\n%s", cell, seconds, error)
+                    failed.append(cell)
+
+                for dependent, baseline in list(waiting.items()):
+                    if baseline != cell:
+                        continue
+                    del waiting[dependent]
+                    if error is None:
+                        running[executor.submit(run_cell, cell_argv(args, dependent))] = dependent
+                    else:
+                        logging.error("Skipped %s: its baseline %s failed", dependent, cell)
+                        failed.append(dependent)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datasets", nargs="+", default=["sgd"])
+    parser.add_argument("--domains", nargs="+", default=["naive_5_shot"])
+    parser.add_argument("--curricula", nargs="+", default=["NC"],
+                        help="[NC, one_pass, baby_step, dcl, dcl.accu, spl.hard, spl.linear, spl.mixture]")
+    parser.add_argument("--seeds", nargs="+", type=int, default=[42])
+    parser.add_argument("--model_type", default="t5", type=str)
+    parser.add_argument("--model_name", default="t5-small", type=str)
+    parser.add_argument("--data_root", default="data", type=str, help="Data of a cell: data_root/dataset/domain")
+    parser.add_argument("--train_file", default="train", type=str, help="Name of the train .src/.trg files.")
+    parser.add_argument("--dev_file", default="dev2", type=str, help="Name of the dev .src/.trg files.")
+    parser.add_argument("--cache_root", default="data_cached", type=str)
+    parser.add_argument("--output_root", default="saved_models", type=str, help="Output of a cell: output_root/cell_dir")
+    parser.add_argument("--cell_dir", default="{dataset}/{domain}/{curriculum}/seed_{seed}", type=str,
+                        help="Output dir of a cell under output_root. Formatted with dataset, domain, curriculum and "
+                             "seed: it must tell the cells of the grid apart.")
+    parser.add_argument("--num_workers", default=0, type=int, help="0 to size the pool by cores and memory.")
+    parser.add_argument("--threads_per_worker", default=1, type=int, help="torch threads of each worker.")
+    parser.add_argument("--worker_memory_gb", default=4.0, type=float, help="Host memory needed per worker.")
+    parser.add_argument("exp_args", nargs=argparse.REMAINDER, help="-- followed by arguments for exp.py")
+    args = parser.parse_args()
+    args.exp_args = args.exp_args[1:] if args.exp_args[:1] == ["--"] else args.exp_args
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    failed = run_grid(args)
+    if failed:
+        raise SystemExit(f"{len(failed)} cells failed: {failed}")
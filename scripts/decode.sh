@@ -31,5 +31,4 @@ python exp.py \
     --decode_input_file ${decode_input_file} \
     --decode_tgt_file ${decode_tgt_file} \
     --data_cache_dir ${data_cache_dir} \
-    --overwrite_cache \
     --decode_batch_size ${batch_size}
\ No newline at end of file
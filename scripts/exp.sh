@@ -1,10 +1,55 @@
 #!/bin/bash
 export CUDA_VISIBLE_DEVICES=0
 
+### Curriculum ###
+#[NC, one_pass, baby_step, dcl, dcl.accu, spl.hard, spl.linear, spl.mixture]
 curriculum=$1
-domains="attraction hotel laptop restaurant taxi train tv"
+curriculum_num_bucket=5
 
-for domain in $domains; do
-  echo "$domain"
-  bash scripts/train.sh "$domain" "$curriculum"
-done
+### data ###
+dataset="sgd"
+domains="naive_5_shot naive_10_shot naive_20_shot naive_40_shot naive_80_shot"
+#dataset="fewshotwoz"  # needs {train,dev2}.{src,trg} in each domain folder
+#domains="attraction hotel laptop restaurant taxi train tv"
+
+# dynamic curriculum. The baseline of a dcl cell is the NC cell of its domain
+dcl_phase=5
+dcl_a=1
+dcl_c0=0.2
+dcl_alpha=0.75
+dcl_beta=0.9
+
+### model ###
+model_type=t5
+model_name="t5-small"
+seed=42
+epoch=1000
+train_batch_size=128
+dev_batch_size=128
+lr=1e-3
+
+# same settings and output dirs as scripts/train.sh, for all domains over a pool of workers.
+# Re-running skips the finished cells.
+python run_grid.py \
+  --datasets ${dataset} \
+  --domains ${domains} \
+  --curricula ${curriculum} \
+  --seeds ${seed} \
+  --model_type ${model_type} \
+  --model_name ${model_name} \
+  --train_file train \
+  --dev_file dev2 \
+  --cell_dir "{dataset}/{domain}/{curriculum}_full" \
+  -- \
+  --eval_while_train \
+  --curriculum_num_bucket ${curriculum_num_bucket} \
+  --dcl_phase ${dcl_phase} \
+  --dcl_a ${dcl_a} \
+  --dcl_c0 ${dcl_c0} \
+  --dcl_alpha ${dcl_alpha} \
+  --dcl_beta ${dcl_beta} \
+  --num_train_epochs ${epoch} \
+  --train_batch_size ${train_batch_size} \
+  --dev_batch_size ${dev_batch_size} \
+  --learning_rate ${lr} \
+  --train_patience 1000
@@ -0,0 +1,75 @@
+"""Import cost of exp.py and of each lazily imported metric backend.
+`import exp` is what every mode pays before its first step. It is measured in a fresh interpreter with
+`python -X importtime`, grouped by top-level package. Each metric backend (components.evaluate.METRIC_BACKENDS) is
+then measured on its own: the extra time of loading it in a fresh interpreter that has already imported exp.
+
+usage: python scripts/startup_time.py [--repeat 3] [--top 5]
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_USERS = {  # backend: modes that load it
+    "tokenizer_13a": "train with --eval_while_train or dcl (first dev BLEU), eval",
+    "sacrebleu": "eval",
+    "meteor": "eval",
+    "bleurt": "eval",
+}
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| *(\S+)")  # self [us] | cumulative [us] | module
+
+
+def run(code, *flags):
+    proc = subprocess.run([sys.executable, *flags, "-c", code], cwd=ROOT, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    return proc
+
+
+def measure_exp():
+    """ return: total import time of exp (s), {top-level package: time spent importing its modules (s)} """
+    packages = {}
+    for line in run("import exp", "-X", "importtime").stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            package = match.group(3).split('.')[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1)) / 1e6
+    return sum(packages.values()), packages
+
+
+def measure_backend(name):
+    """ return: time (s) of loading the backend once exp is imported """
+    code = ("import time, exp\n"
+            "from components.evaluate import backend\n"
+            "start = time.perf_counter()\n"
+            f"backend({name!r})\n"
+            "print(time.perf_counter() - start)\n")
+    return float(run(code).stdout.split()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", nargs="+", default=list(BACKEND_USERS), choices=list(BACKEND_USERS))
+    parser.add_argument("--repeat", default=3, type=int, help="Runs per measurement. The fastest one is reported.")
+    parser.add_argument("--top", default=5, type=int, help="Number of most expensive packages to list.")
+    args = parser.parse_args()
+
+    try:
+        total, packages = min((measure_exp() for _ in range(args.repeat)), key=lambda res: res[0])
+    except RuntimeError as e:
+        raise SystemExit(f"import exp failed: {e}")
+    print(f"{'import exp':16s} {total:7.2f}s  (every mode)")
+    for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"    {package:24s} {seconds:7.2f}s")
+
+    for name in args.backends:
+        label = f"+ {name}"
+        try:
+            seconds = min(measure_backend(name) for _ in range(args.repeat))
+        except RuntimeError as e:
+            print(f"{label:16s} failed: {e}")
+            continue
+        print(f"{label:16s} {seconds:7.2f}s  ({BACKEND_USERS[name]})")
@@ -1,3 +1,4 @@
+import os
 import json
 import seaborn as sns
 import numpy as np
@@ -13,15 +14,52 @@ curriculums = ["NC", "one_pass", "baby_step", "dcl", "dcl.accu"]
 figure_path = "visualize/results"
 
 
-def read_history_json(path):
-    """ keys = {batch_losses, batch_ex_seen, epoch_losses, epoch_ex_seen, eval_losses}"""
+def read_history_json(path, keys=None):
+    """ keys = {batch_losses, batch_ex_seen, epoch_losses, epoch_ex_seen, neg_bleu, slot_accu}
+    Reads both history.json and the streamed history.jsonl. Only `keys` are loaded if given.
+    """
+    if path.endswith(".jsonl"):
+        return read_history_jsonl(path, keys)
     with open(path, 'r') as fp:
         history = json.load(fp)
     return history
 
 
+def iter_history_records(path, record_types=None):
+    """ lazily yield the records of history.jsonl, skipping lines of other record types without parsing them """
+    prefixes = None if record_types is None else tuple(f'{{"type": "{t}"' for t in record_types)
+    with open(path, 'r') as fp:
+        for line in fp:
+            if line.strip() and (prefixes is None or line.startswith(prefixes)):
+                yield json.loads(line)
+
+
+def read_history_jsonl(path, keys=None):
+    """ aggregate history.jsonl into the history.json layout: key -> [[values of curriculum 0], ...] """
+    record_types = None
+    if keys is not None:
+        record_types = {"batch" if k.startswith("batch") else "epoch" for k in keys}
+
+    history, num_curriculum = {}, 0
+    for record in iter_history_records(path, record_types):
+        curriculum = record["curriculum"]
+        num_curriculum = max(num_curriculum, curriculum + 1)
+        for k, v in record.items():
+            if k in ["type", "curriculum"] or (keys is not None and k not in keys):
+                continue
+            values = history.setdefault(k, [])
+            values.extend([] for _ in range(curriculum + 1 - len(values)))
+            values[curriculum].append(v)
+
+    for k in (keys if keys is not None else list(history)):
+        values = history.setdefault(k, [])
+        values.extend([] for _ in range(num_curriculum - len(values)))
+    return history
+
+
 def get_hist_path(domain, curriculum):
-    return f"{base_output_dir}/{dataset_name}/{domain}/{curriculum}/history.json"
+    path = f"{base_output_dir}/{dataset_name}/{domain}/{curriculum}/history.jsonl"
+    return path if os.path.exists(path) else path[:-1]  # fall back to history.json of older runs
 
 
 def flatten_list(nested_list):
@@ -41,7 +79,7 @@ def plot_epoch_bleu(domain, saveto, curriculums):
 
     for curriculum in curriculums:
         path = get_hist_path(domain, curriculum)
-        history = read_history_json(path)
+        history = read_history_json(path, keys=['epoch_ex_seen', 'neg_bleu'])
         ex_seen, losses = history['epoch_ex_seen'], history['neg_bleu']
         ex_seen, losses = flatten_list(ex_seen), flatten_list(losses)
         bleus = [-loss for loss in losses]